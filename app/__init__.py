@@ -1,44 +1,95 @@
-from quart import Quart, render_template, Response, redirect, url_for
-from picamera2 import Picamera2
-import cv2
-import os
+from quart import Quart, render_template, Response, redirect, request, url_for
+import asyncio
 import logging
-from datetime import datetime
+import os
+import threading
+
+from frame_broadcast import FrameBroadcaster
+from frame_pipeline import FramePipeline
+from frame_source import open_source
+from photo_catalog import PhotoCatalog
+from photo_delivery import file_validators, not_modified, send_data, send_photo
+from photo_exif import build_exif
+from photo_store import PhotoWriter
+from photo_thumbs import ThumbnailCache
+from photo_tiles import TilePyramid
 
 app = Quart(__name__)
-picam2 = Picamera2()
 
-# Configure preview and capture modes
-preview_config = picam2.create_preview_configuration()
-capture_config = picam2.create_still_configuration()
-picam2.configure(preview_config)
-picam2.start(show_preview=False)
+# The camera is opened when the server starts; CAMERA_SOURCE selects the
+# backend (picamera2, opencv or synthetic)
+source = None
+pipeline = None
+
+# One producer captures and encodes each frame; every feed client reads it
+broadcaster = FrameBroadcaster()
+# One still at a time: the mode switch and the source's still metadata are shared
+capture_lock = threading.Lock()
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logging.info("Application started.")
 
-# Ensure the capture directory exists
+# Stills are encoded and written in the background into the capture directory
 CAPTURE_DIR = '/home/scanpi/photos'
-os.makedirs(CAPTURE_DIR, exist_ok=True)
+# Every photo is indexed as it is written, so listing never scans the folder
+catalog = PhotoCatalog(CAPTURE_DIR)
+# Previews are decoded at reduced size and cached; new captures are warmed from memory
+thumbnails = ThumbnailCache(CAPTURE_DIR, warm_widths=(320, 640))
+# Deep-zoom tiles let the viewer fetch only what is on screen of a full-size still; built on first view
+tiles = TilePyramid(CAPTURE_DIR)
+writer = PhotoWriter(CAPTURE_DIR, prefix='capture', catalog=catalog, derivatives=(thumbnails,))
+
+@app.before_serving
+async def start_camera():
+    """Open the camera and start the frame producer."""
+    global source, pipeline
+    # HD main stream plus an ISP-scaled SD stream; the 320 wide rendition is scaled from SD
+    source = open_source(size=(1280, 960), lores_size=(640, 480))
+    source.start()
+    pipeline = FramePipeline(source, broadcaster, renditions=(640, 320))
+    pipeline.start()
+    logging.info("Camera started.")
+    # Pick up photos added or deleted over Samba
+    catalog.start(interval=60)
+
+@app.after_serving
+async def release_camera():
+    """Stop the frame producer and release the camera."""
+    if pipeline:
+        pipeline.stop()
+    if source:
+        source.stop()
+        logging.info("Camera released.")
+    # Let queued stills finish writing before the process exits
+    await asyncio.to_thread(writer.shutdown)
+    catalog.stop()
 
 @app.route('/')
 async def index():
     """Render the main page."""
-    return await render_template('index.html')
+    latest = catalog.latest()
+    capture_url = url_for('get_photo', filepath=latest['path'], w=640) if latest else None
+    return await render_template('index.html', size=request.args.get('size'), capture_url=capture_url,
+                                 capture_path=latest and latest['path'])
 
-def generate_frames():
-    """Generator for video feed frames."""
+async def generate_frames(rendition):
+    """Async generator for video feed frames from one rendition's broadcaster.
+
+    Capture and encode run on the pipeline thread, so waiting for the next
+    frame never blocks the event loop or ties up an executor thread.
+    """
     try:
-        while True:
-            logging.debug("Generating a new frame for the video feed.")
-            frame = picam2.capture_array("main")  # Capture frame in preview mode
-            _, buffer = cv2.imencode('.jpg', frame)
-            frame_bytes = buffer.tobytes()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-    except GeneratorExit:
+        with rendition.client() as client:
+            while True:
+                sequence, frame_bytes = await client.get()
+                logging.debug(f"Sending frame {sequence} to the video feed.")
+                yield (b'--frame\r\n'
+                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+                client.sent += 1
+    except (GeneratorExit, asyncio.CancelledError):
         logging.info("Client disconnected from video feed.")
+        raise
     except Exception as e:
         logging.error(f"Error generating video feed: {e}")
         raise
@@ -46,27 +97,136 @@ def generate_frames():
 
 @app.route('/video_feed')
 async def video_feed():
-    """Route for video feed."""
-    return Response(generate_frames(),
+    """Route for video feed; ?size= picks the rendition (320, 640, 1280 or thumb/sd/hd)."""
+    try:
+        rendition = pipeline.rendition(request.args.get('size', 'sd'))
+    except ValueError:
+        return "Unknown size", 400
+    return Response(generate_frames(rendition),
                     content_type='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/capture')
 async def capture():
-    """Capture a high-resolution image."""
+    """Capture a high-resolution image, optionally into ?folder= and with comma-separated ?tags=."""
+    tags = request.args.get('tags')
     try:
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = os.path.join(CAPTURE_DIR, f'capture_{timestamp}.jpg')
-        logging.info(f"Capturing photo: {filename}")
+        path = writer.next_path(folder=request.args.get('folder'))
+    except ValueError as e:
+        return str(e), 400
+    try:
+        # Capture off the event loop so streams keep running; the write happens in the background
+        def safe_capture():
+            with capture_lock:
+                array = source.capture_still()
+                return array, source.still_metadata, source.still_latency
 
-        # Capture and save the photo
-        array = picam2.switch_mode_and_capture_array(capture_config, "main")
-        cv2.imwrite(filename, array)
-        logging.info(f"Photo saved: {filename}")
+        array, metadata, latency = await asyncio.to_thread(safe_capture)
+        exif = build_exif(tags, metadata=metadata, model=source.model)
+        filename, _ = await asyncio.to_thread(writer.submit, array, path, exif=exif, tags=tags)
+        logging.info(f"Photo queued: {filename} (captured in {latency * 1000:.0f} ms)")
 
         return redirect(url_for('index'))
     except Exception as e:
         logging.error(f"Error capturing photo: {e}")
         return "Error capturing photo", 500
 
+@app.route('/photos')
+async def photos():
+    """List catalogued photos, newest first.
+
+    Filter with any of ?folder=, ?tag= and a ?since=/&until= Unix time
+    range, which combine; page with ?limit= and ?offset=.
+    """
+    try:
+        limit = min(int(request.args.get('limit', 100)), 1000)
+        offset = int(request.args.get('offset', 0))
+        since = float(request.args['since']) if 'since' in request.args else None
+        until = float(request.args['until']) if 'until' in request.args else None
+    except ValueError:
+        return {"error": "limit, offset, since and until must be numbers"}, 400
+    rows = catalog.find(request.args.get('folder'), request.args.get('tag'), since, until, limit, offset)
+    return {"photos": rows}
+
+@app.route('/photos/latest')
+async def latest_photo():
+    """Return the newest catalogued photo, in ?folder= if given."""
+    return {"photo": catalog.latest(request.args.get('folder'))}
+
+@app.route('/get_photo/<path:filepath>')
+async def get_photo(filepath):
+    """Serve a catalogued photo, scaled down to ?w= pixels wide if given.
+
+    The catalog lookup replaces a filesystem check.  Responses carry an ETag
+    and Last-Modified, so revalidation gets a 304, and full-size photos
+    honour Range requests.
+    """
+    if catalog.get(filepath) is None:
+        return {"error": "Photo not found."}, 404
+    photo_path = os.path.join(catalog.root, filepath)
+    width = request.args.get('w', type=int)
+    try:
+        if width:
+            etag, last_modified, _ = file_validators(photo_path)
+            etag = f"{etag}-w{thumbnails.snap(width)}"
+            # Checked before rendering, so a cached preview costs the Pi nothing
+            response = not_modified(etag, last_modified)
+            if response is not None:
+                return response
+            data = await asyncio.to_thread(thumbnails.get, filepath, width)
+            if data is not None:
+                return send_data(data, etag, last_modified)
+        return await send_photo(photo_path, root=catalog.root)
+    except FileNotFoundError:
+        # Deleted behind the catalog's back; forget it until the next sync
+        catalog.remove(filepath)
+        return {"error": "Photo not found."}, 404
+
+@app.route('/view/<path:filepath>')
+async def view_photo(filepath):
+    """Render a pan-and-zoom viewer of a catalogued photo."""
+    if catalog.get(filepath) is None:
+        return {"error": "Photo not found."}, 404
+    if not os.path.exists(os.path.join(app.static_folder, 'openseadragon', 'openseadragon.min.js')):
+        # Vendored by install.sh rather than loaded from a CDN
+        return {"error": "OpenSeadragon is not installed in app/static/openseadragon; run install.sh."}, 503
+    # Built on first view, on a worker of its own, so writing new photos never waits for it
+    tiles.prefetch(filepath)
+    return await render_template('viewer.html', filepath=filepath,
+                                 dzi_url=url_for('photo_dzi', filepath=filepath))
+
+@app.route('/tiles/<path:filepath>.dzi')
+async def photo_dzi(filepath):
+    """Serve the Deep Zoom descriptor of a catalogued photo, tiling it first if needed."""
+    if catalog.get(filepath) is None:
+        return {"error": "Photo not found."}, 404
+    try:
+        descriptor = await asyncio.to_thread(tiles.dzi, filepath)
+    except FileNotFoundError:
+        return {"error": "Photo not found."}, 404
+    return Response(descriptor, content_type='application/xml')
+
+@app.route('/tiles/<path:filepath>_files/<int:level>/<int:col>_<int:row>.jpg')
+async def photo_tile(filepath, level, col, row):
+    """Serve one tile of a catalogued photo's pyramid, with validators like the photo itself."""
+    if catalog.get(filepath) is None:
+        return {"error": "Photo not found."}, 404
+    try:
+        tile_path = await asyncio.to_thread(tiles.tile, filepath, level, col, row)
+        # root as for photos: .tiles lives under it, so X-Accel-Redirect gets the whole relative path
+        return await send_photo(tile_path, root=catalog.root)
+    except FileNotFoundError:
+        return {"error": "Tile not found."}, 404
+
+@app.route('/photos/status')
+async def photos_status():
+    """Report stills still waiting to be written, and write totals."""
+    return writer.status()
+
+@app.route('/stats')
+async def stats():
+    """Report producer throughput, per-stage latency and CPU per frame."""
+    return {"clients": broadcaster.client_stats(), "pipeline": pipeline.report(), "thumbnails": thumbnails.stats(),
+            "tiles": tiles.stats(), "dual_stream": source.dual_stream, "still_capture_ms": source.still_latency and source.still_latency * 1000}
+
 # Expose the app for ASGI servers
 quart_app = app
@@ -1,69 +1,333 @@
-from quart import Quart, websocket, render_template
+from quart import Quart, websocket, render_template, request, Response, url_for
 import threading
-import time
-from picamera2 import Picamera2, Preview
-import cv2
 import asyncio
-from datetime import datetime
-import os
+import time
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from frame_broadcast import FrameBroadcaster
+from frame_hls import LiveHls
+from frame_inference import Imx500Inference
+from frame_motion import ChangeGate, MotionDetector
+from frame_overlay import Overlay
+from frame_ring import FrameRing
+from frame_pipeline import FramePipeline
+from frame_protocol import JPEG, KINDS, MessageCache, multiplex
+from frame_recorder import SegmentedRecorder
+from frame_source import open_source
+from photo_catalog import PhotoCatalog
+from photo_delivery import send_photo
+from photo_exif import build_exif
+from photo_store import PhotoWriter
 
 # Create a Quart app instance
 app = Quart(__name__)
 
 # Global variables
-video_frame = None
+broadcaster = FrameBroadcaster()
+messages = MessageCache()  # Each frame is packed once for all /ws clients
+source = None
+pipeline = None
 lock = threading.Lock()
 photo_dir = "/home/scanpi/photos"
-os.makedirs(photo_dir, exist_ok=True)
+catalog = PhotoCatalog(photo_dir)  # Indexes every photo as it is written
+MAX_BURST = 20  # Each 12MP still is ~37MB; the writer holds at most max_pending of them at once
+# Write-behind: stills are encoded and written in the background, a whole burst may be queued
+writer = PhotoWriter(photo_dir, workers=3, max_pending=MAX_BURST, catalog=catalog)
+
+# RING_BUFFER_MB keeps that much of the 640 wide stream in memory, so a capture or motion trigger
+# also saves a clip of the CLIP_BEFORE seconds before it and the CLIP_AFTER seconds after
+RING_BUFFER_MB = int(os.environ.get("RING_BUFFER_MB", 0))
+CLIP_BEFORE = float(os.environ.get("CLIP_BEFORE", 10))
+CLIP_AFTER = float(os.environ.get("CLIP_AFTER", 5))
+ring = FrameRing(RING_BUFFER_MB * 1024 * 1024) if RING_BUFFER_MB else None
+clip_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="clip-writer")
+
+# RECORD=1 records continuously as 10 s H.264 segments, deleting the oldest beyond RECORD_BUDGET_GB
+RECORD_BUDGET_GB = float(os.environ.get("RECORD_BUDGET_GB", 8))
+recorder = SegmentedRecorder(os.path.join(photo_dir, "recordings"), segment_seconds=10,
+                             budget_bytes=int(RECORD_BUDGET_GB * 1024 ** 3))
+
+# Live HLS of the 640 wide stream, encoded once for every viewer and kept in memory; /live plays it
+hls = LiveHls(segment_seconds=1, segments=6)
+
+def write_clip(clip_path, before, after):
+    try:
+        ring.save_clip(clip_path, before, after)
+    except Exception as e:
+        logging.error(f"Failed to save clip {clip_path}: {e}")
+
+def save_clip(before=CLIP_BEFORE, after=CLIP_AFTER):
+    # Returns the clip's path straight away; it is on disk about after seconds later
+    if ring is None:
+        return None
+    clip_path = writer.next_path(prefix="clip", folder="clips", extension=".mkv")
+    clip_executor.submit(write_clip, clip_path, before, after)
+    return clip_path
+
+def motion_capture(event):
+    # Runs on the detector's trigger thread: take a full-resolution still of the motion
+    clip_path = save_clip()
+    with lock:
+        array = source.capture_still()
+        tags = ",".join(["motion"] + event["zones"])
+        exif = build_exif(tags, metadata=source.still_metadata, model=source.model)
+    photo_path, _ = writer.submit(array, writer.next_path(prefix="motion"), exif=exif, tags=tags)
+    motion.publish({"type": "capture", "sequence": event["sequence"], "photo": photo_path, "clip": clip_path})
+
+# Motion detection on the lores stream; MOTION_DETECT=1 starts it, MOTION_CAPTURE=1 also takes stills
+motion = MotionDetector(on_trigger=motion_capture, enabled=os.environ.get("MOTION_DETECT") == "1",
+                        trigger=os.environ.get("MOTION_CAPTURE") == "1")
+
+# IMX500_MODEL names an .rpk network for the AI camera; its results are streamed on /ws/inference
+IMX500_MODEL = os.environ.get("IMX500_MODEL")
+inference = None
+# Motion and inference results drawn once per frame for ?overlay=1 clients, or sent as JSON on /ws/overlay
+overlay = None
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 
-# Initialize Picamera2
-picam2 = Picamera2()
-## picam2.configure(picam2.create_video_configuration(main={"size": (640, 480)}))
-picam2.configure(picam2.create_video_configuration(main={"size": (1280, 960)}))  # Doubled resolution
-picam2.start()
-
 # Function to capture video frames
 def video_stream():
-    global video_frame
-    while True:
-        frame = picam2.capture_array()
-        _, buffer = cv2.imencode('.jpg', frame)
-        video_frame = buffer.tobytes()
-        time.sleep(0.03)  # Approx. 30 FPS
+    pipeline.run()
 
 @app.websocket("/ws")
 async def ws():
-    global video_frame
-    while True:
-        if video_frame:
-            await websocket.send(video_frame)
-        await asyncio.sleep(0.03)
+    # ?size= picks the rendition: 320, 640, 1280 or thumb/sd/hd; ?overlay=1 has the annotations drawn in
+    # Binary frame_protocol messages: the JPEGs, and the ?meta= events (motion,inference by default) on one socket
+    try:
+        rendition = pipeline.rendition(websocket.args.get("size"), overlay=websocket.args.get("overlay") == "1")
+    except ValueError:
+        return "Unknown size", 400
+    events = {"motion": motion.events, "overlay": overlay and overlay.events,
+              "inference": inference and inference.events}
+    meta = [name for name in websocket.args.get("meta", "motion,inference").split(",") if name]
+    if any(name not in events for name in meta):
+        return f"meta must be a list of {', '.join(events)}", 400
+    streams = [(JPEG, rendition, pipeline.rendition_width(rendition), 1)]
+    # Metadata queues are deeper than the video's: events are small and none should be dropped
+    streams += [(KINDS[name], events[name], 0, 16) for name in meta if events[name] is not None]
+    # Wake once per new frame or event; a slow client skips to the newest frame
+    await multiplex(websocket.send, streams, messages)
+
+@app.websocket("/ws/motion")
+async def ws_motion():
+    # Motion start/end and triggered captures as JSON text messages
+    with motion.events.client(maxsize=16) as client:
+        while True:
+            _, event = await client.get()
+            await websocket.send(event)
+            client.sent += 1
+
+@app.websocket("/ws/overlay")
+async def ws_overlay():
+    # The annotations of the current frame as JSON, for clients drawing them over the clean stream
+    with overlay.events.client(maxsize=4) as client:
+        while True:
+            _, annotations = await client.get()
+            await websocket.send(annotations)
+            client.sent += 1
+
+@app.websocket("/ws/inference")
+async def ws_inference():
+    # IMX500 classifications or detections as JSON text messages, tagged with the frame sequence number
+    if inference is None:
+        return "No IMX500 network loaded", 404
+    with inference.events.client(maxsize=4) as client:
+        while True:
+            _, result = await client.get()
+            await websocket.send(result)
+            client.sent += 1
+
+@app.route("/motion", methods=["GET", "POST"])
+async def motion_settings():
+    # POST a JSON object of settings (enabled, threshold, min_area, cooldown, trigger, zones, ...) to change them
+    if request.method == "POST":
+        settings = await request.get_json(force=True) or {}
+        if not isinstance(settings, dict):
+            return {"error": "The body must be a JSON object"}, 400
+        try:
+            motion.configure(**settings)
+        except ValueError as e:
+            return {"error": str(e)}, 400
+    return motion.as_dict()
 
 @app.route("/capture", methods=["POST"])
 async def capture():
     # Use a thread-safe mechanism to avoid locking issues
     def safe_capture():
         with lock:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            photo_path = os.path.join(photo_dir, f"photo_{timestamp}.jpg")
-            #capture_config = picam2.create_still_configuration()
-            capture_config = picam2.create_still_configuration(main={"size": (4056, 3040)})  # Full 12MP resolution
-            array = picam2.switch_mode_and_capture_array(capture_config, "main")
-            cv2.imwrite(photo_path, array)
-            logging.info(f"Photo saved: {photo_path}")
+            array = source.capture_still()
+            latency = source.still_latency
+            exif = build_exif(metadata=source.still_metadata, model=source.model)
+        # Returns once the still is queued; /photos/status shows when it is on disk
+        photo_path, _ = writer.submit(array, exif=exif)
+        return photo_path, latency
 
-    await asyncio.to_thread(safe_capture)
-    return "", 204
+    clip_path = save_clip()
+    photo_path, latency = await asyncio.to_thread(safe_capture)
+    return {"photo": photo_path, "capture_ms": round(latency * 1000, 1), "clip": clip_path}
+
+@app.route("/clip", methods=["POST"])
+async def clip():
+    # Save the ?before= seconds already buffered and the ?after= seconds to come, without re-encoding
+    if ring is None:
+        return {"error": "No ring buffer; set RING_BUFFER_MB"}, 404
+    try:
+        before = float(request.args.get("before", CLIP_BEFORE))
+        after = float(request.args.get("after", CLIP_AFTER))
+    except ValueError:
+        return {"error": "before and after must be numbers"}, 400
+    if not (0 <= before and 0 <= after <= 60):
+        return {"error": "before must not be negative and after must be between 0 and 60"}, 400
+    return {"clip": save_clip(before, after), "buffered_s": ring.status()["seconds"]}
+
+@app.route("/recordings")
+async def recordings():
+    # Finished segments overlapping ?since= and ?until= (Unix times), oldest first
+    try:
+        since = float(request.args["since"]) if "since" in request.args else None
+        until = float(request.args["until"]) if "until" in request.args else None
+    except ValueError:
+        return {"error": "since and until must be Unix times"}, 400
+    return {"segments": recorder.segments(since, until), "recording": recorder.recording}
+
+@app.route("/recordings/<name>")
+async def recording(name):
+    if name not in {segment["name"] for segment in recorder.segments()}:
+        return {"error": "No such segment"}, 404
+    try:
+        return await send_photo(os.path.join(recorder.directory, name), mimetype="video/mp2t", root=photo_dir)
+    except FileNotFoundError:
+        return {"error": "No such segment"}, 404
+
+@app.route("/record/<action>", methods=["POST"])
+async def record(action):
+    if action == "start":
+        await asyncio.to_thread(recorder.start, source)
+    elif action == "stop":
+        await asyncio.to_thread(recorder.stop)
+    else:
+        return {"error": "action must be start or stop"}, 404
+    return recorder.status()
+
+@app.route("/live")
+async def live():
+    # hls.js is vendored by install.sh; without it only browsers that play HLS natively can watch
+    hls_js = os.path.exists(os.path.join(app.static_folder, "hls", "hls.min.js"))
+    return await render_template("live_hls.html", hls_js=hls_js and url_for("static", filename="hls/hls.min.js"))
+
+@app.route("/live/index.m3u8")
+async def live_playlist():
+    # ?_HLS_msn= holds the request until that segment is ready (an LL-HLS blocking reload)
+    hls.touch(request.remote_addr)
+    if not hls.running:
+        await asyncio.to_thread(hls.start, source, (640, 480))
+    try:
+        msn = int(request.args["_HLS_msn"]) if "_HLS_msn" in request.args else None
+    except ValueError:
+        return {"error": "_HLS_msn must be an integer"}, 400
+    if msn is not None and hls.too_far(msn):
+        return {"error": "_HLS_msn is more than two segments ahead of the stream"}, 400
+    if msn is not None and not hls.has(msn):
+        with hls.events.client(maxsize=4) as client:
+            try:
+                while not hls.has(msn):
+                    await asyncio.wait_for(client.get(), timeout=hls.segment_seconds * 3)
+                    hls.touch(request.remote_addr)
+            except asyncio.TimeoutError:
+                return {"error": "Segment not ready"}, 503
+    response = Response(hls.playlist(), content_type="application/vnd.apple.mpegurl")
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@app.route("/live/<int:sequence>.ts")
+async def live_segment(sequence):
+    # Served from memory; every viewer fetches the same few segments
+    hls.touch(request.remote_addr)
+    data = hls.segment(sequence)
+    if data is None:
+        return {"error": "Segment no longer cached"}, 404
+    response = Response(data, content_type="video/mp2t")
+    response.headers["Cache-Control"] = "max-age=60"
+    return response
+
+@app.route("/burst", methods=["POST"])
+async def burst():
+    # Capture ?count= stills back to back with one mode switch; workers encode and write them in the background
+    try:
+        count = int(request.args.get("count", 5))
+    except ValueError:
+        return {"error": "count must be an integer"}, 400
+    if not 1 <= count <= MAX_BURST:
+        return {"error": f"count must be between 1 and {MAX_BURST}"}, 400
+
+    def capture_burst():
+        writes = []
+
+        def queue_still(array, metadata):
+            # Queued as it arrives, so workers write while the burst goes on; blocks once max_pending are waiting
+            writes.append(writer.submit(array, exif=build_exif(metadata=metadata, model=source.model)))
+
+        with lock:
+            start = time.perf_counter()
+            source.capture_burst(count, queue_still)
+            return writes, time.perf_counter() - start
+
+    writes, capture_time = await asyncio.to_thread(capture_burst)
+    logging.info(f"Burst of {count} captured at {source.burst_fps:.1f} fps")
+    return {"photos": [path for path, _ in writes], "count": count,
+            "capture_ms": round(capture_time * 1000, 1), "fps": round(source.burst_fps, 2)}
+
+@app.route("/photos/status")
+async def photos_status():
+    # Stills still waiting to be written, and write totals
+    return writer.status()
+
+@app.route("/stats")
+async def stats():
+    # Producer throughput, per-stage latency and CPU per frame
+    return {"clients": broadcaster.client_stats(), "pipeline": pipeline.report(),
+            "dual_stream": source.dual_stream, "still_capture_ms": source.still_latency and source.still_latency * 1000,
+            "burst_fps": source.burst_fps, "motion": motion.as_dict(),
+            "inference": inference and inference.as_dict(), "overlay": overlay.as_dict(),
+            "ring": ring and ring.status(), "recorder": recorder.status(), "hls": hls.status(),
+            "messages": {"packed": messages.packed, "shared": messages.hits}}
 
 @app.route("/")
 async def index():
     return await render_template("thread_video_index_working.html")
 
 if __name__ == "__main__":
+    # Open the camera backend selected by CAMERA_SOURCE (picamera2, opencv or synthetic)
+    # Doubled resolution with an ISP-scaled 640x480 stream, full 12MP stills
+    options = {}
+    if IMX500_MODEL:
+        # The network firmware is loaded before the camera is opened, on the IMX500's own camera
+        inference = Imx500Inference(IMX500_MODEL)
+        options["picam2"] = inference.picam2
+    source = open_source(size=(1280, 960), fps=30, still_size=(4056, 3040), lores_size=(640, 480), **options)
+    source.start()
+    # Runs at the sensor frame rate; 640 and 320 wide renditions are encoded only while watched
+    # Unchanged frames (a still scan bed) are not re-encoded or re-sent, only a keep-alive once a second
+    gate = ChangeGate(enabled=os.environ.get("CHANGE_GATE", "1") == "1")
+    # The recorder and HLS only take frames from the pipeline when there is no hardware encoder
+    analysers = [motion, recorder, hls] if inference is None else [motion, inference, recorder, hls]
+    overlay = Overlay(motion=motion, inference=inference)
+    pipeline = FramePipeline(source, broadcaster, renditions=(640, 320), analysers=analysers, gate=gate,
+                             overlay=overlay)
+    if ring is not None:
+        # The ISP-scaled 640 wide stream is encoded without a colour conversion
+        ring.start(pipeline.rendition("sd"))
+
+    if os.environ.get("RECORD") == "1":
+        recorder.start(source)
+
+    # Keep the photo catalog in step with files added or deleted over Samba
+    catalog.start(interval=60)
+
     # Start the video stream thread
     video_thread = threading.Thread(target=video_stream, daemon=True)
     video_thread.start()
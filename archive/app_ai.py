@@ -1,4 +1,9 @@
 from quart import Quart, Response, render_template, request, send_file
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import io
 import os
 from datetime import datetime
 from PIL import Image
@@ -22,26 +27,123 @@ camera.configure(camera.create_preview_configuration())
 camera.start()
 
 
-def generate_frames():
+# Capture and encode run on one dedicated worker thread, off the event loop
+camera_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="camera")
+
+# Previews for /get_photo?w=, rendered on their own workers and cached in memory and on disk
+THUMB_DIR = os.path.join(BASE_PHOTO_DIR, '.thumbs')
+THUMB_WIDTHS = (160, 320, 640, 1280)  # Requested widths are rounded up to one of these
+os.makedirs(THUMB_DIR, exist_ok=True)
+thumb_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="thumbs")
+
+
+def capture_jpeg():
+    """Capture a frame and encode it as JPEG bytes (runs on the camera worker)."""
+    frame = camera.capture_array()
+    if frame is None:
+        logging.warning("No frame captured. Retrying...")
+        return None
+
+    success, buffer = cv2.imencode('.jpg', frame)
+    if not success:
+        logging.warning("Failed to encode frame. Retrying...")
+        return None
+
+    return buffer.tobytes()
+
+
+def tag_jpeg(jpeg, tags):
+    """Return JPEG bytes with tags and the capture time in their EXIF block.
+
+    The EXIF block is spliced into the encoded bytes in memory, so tagging
+    costs a copy rather than a decode and a second, lossy encode.
+    """
+    exif_dict = piexif.load(jpeg)
+    stamp = datetime.now().strftime("%Y:%m:%d %H:%M:%S").encode()
+    exif_dict["0th"][piexif.ImageIFD.ImageDescription] = tags.encode('utf-8')
+    exif_dict["0th"][piexif.ImageIFD.XPKeywords] = tuple((tags + "\0").encode('utf-16-le'))
+    exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal] = stamp
+    output = io.BytesIO()
+    piexif.insert(piexif.dump(exif_dict), jpeg, output)
+    return output.getvalue()
+
+
+def capture_still_jpeg():
+    """Capture a still as JPEG bytes carrying the camera's EXIF (runs on the camera worker)."""
+    request = camera.capture_request()
+    try:
+        # Picamera2 encodes once and fills in exposure, gain and camera model
+        buffer = io.BytesIO()
+        request.save("main", buffer, format="jpeg")
+    finally:
+        request.release()
+    return buffer.getvalue()
+
+
+@functools.lru_cache(maxsize=256)
+def cached_thumbnail(photo_path, mtime_ns, size, width):
+    """Return the photo scaled to width as JPEG bytes, or None if it is no wider.
+
+    The key includes mtime and size, so a replaced photo is rendered again.
+    The on-disk cache survives restarts; a miss decodes in JPEG draft mode,
+    where libjpeg scales by 1/2, 1/4 or 1/8 while decoding, so a preview
+    never decodes the full 12MP image.
+    """
+    key = hashlib.sha1(f"{photo_path}|{mtime_ns}|{size}|{width}".encode()).hexdigest()
+    cache_path = os.path.join(THUMB_DIR, f'{key}.jpg')
+    try:
+        with open(cache_path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    with Image.open(photo_path) as img:
+        if img.width <= width:
+            return None
+        height = round(img.height * width / img.width)
+        img.draft('RGB', (width, height))
+        img = img.convert('RGB').resize((width, height), Image.LANCZOS)
+        output = io.BytesIO()
+        img.save(output, 'jpeg', quality=80)
+    data = output.getvalue()
+
+    # Rename into place so a concurrent reader never sees half a file
+    temp_path = f'{cache_path}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, cache_path)
+    return data
+
+
+def thumbnail(photo_path, width):
+    """Return a cached preview of photo_path at least width pixels wide (runs on a thumb worker)."""
+    stat = os.stat(photo_path)
+    width = next((w for w in THUMB_WIDTHS if w >= width), THUMB_WIDTHS[-1])
+    return cached_thumbnail(photo_path, stat.st_mtime_ns, stat.st_size, width)
+
+
+def warm_thumbnail(photo_path, width=320):
+    """Render a new capture's preview before the gallery asks for it."""
+    try:
+        thumbnail(photo_path, width)
+    except Exception as e:
+        logging.warning(f"Failed to render thumbnail for {photo_path}: {e}")
+
+
+async def generate_frames():
+    loop = asyncio.get_running_loop()
     while True:
         try:
-            # Capture a frame
-            frame = camera.capture_array()
+            # Wait for the worker without blocking other requests
+            frame = await loop.run_in_executor(camera_executor, capture_jpeg)
             if frame is None:
-                logging.warning("No frame captured. Retrying...")
                 continue
 
-            # Encode the frame as JPEG
-            success, buffer = cv2.imencode('.jpg', frame)
-            if not success:
-                logging.warning("Failed to encode frame. Retrying...")
-                continue
-
-            frame = buffer.tobytes()
-
             # Yield the frame as part of the response
             yield (b'--frame\r\n'
                    b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             logging.error(f"Error in frame generation: {e}")
             break
@@ -73,35 +175,41 @@ async def capture_photo():
     folder_path = os.path.join(BASE_PHOTO_DIR, sanitized_folder_name)
     os.makedirs(folder_path, exist_ok=True)
 
-    # Capture the photo
+    # Capture, encode and tag the photo in one pass, then write it once
     photo_path = os.path.join(folder_path, f'photo_{datetime.now().strftime("%Y%m%d_%H%M%S")}.jpg')
-    camera.capture_file(photo_path)
-
-    logging.info(f"Photo saved at {photo_path}")
-
+    loop = asyncio.get_running_loop()
     try:
-        # Add metadata (tags) to the photo using piexif
-        exif_dict = piexif.load(photo_path)
-        exif_dict["0th"][piexif.ImageIFD.ImageDescription] = tags.encode('utf-8')
-        exif_bytes = piexif.dump(exif_dict)
-
-        # Save the updated photo with EXIF
-        with Image.open(photo_path) as img:
-            img.save(photo_path, "jpeg", exif=exif_bytes)
-
-        logging.info(f"EXIF metadata updated for {photo_path} with tags: {tags}")
-        return {"message": "Photo captured successfully.", "photo_path": photo_path}, 200
+        jpeg = await loop.run_in_executor(camera_executor, capture_still_jpeg)
+    except Exception as e:
+        logging.error(f"Failed to capture photo: {e}")
+        return {"error": "Failed to capture photo."}, 500
+    try:
+        jpeg = tag_jpeg(jpeg, tags)
+        message = "Photo captured successfully."
     except Exception as e:
         logging.error(f"Failed to add EXIF metadata: {e}")
-        return {"message": "Photo saved, but failed to update EXIF metadata.", "photo_path": photo_path}, 200
+        message = "Photo saved, but failed to update EXIF metadata."
+
+    with open(photo_path, 'wb') as f:
+        f.write(jpeg)
+    logging.info(f"Photo saved at {photo_path} with tags: {tags}")
+    loop.run_in_executor(thumb_executor, warm_thumbnail, photo_path)
+    return {"message": message, "photo_path": photo_path}, 200
 
 
 @app.route('/get_photo/<path:filepath>')
 async def get_photo(filepath):
-    """Serve the captured photo."""
+    """Serve the captured photo, scaled down to ?w= pixels wide if given."""
     photo_path = os.path.join(BASE_PHOTO_DIR, filepath)
     if os.path.exists(photo_path):
-        return await send_file(photo_path, mimetype='image/jpeg')
+        width = request.args.get('w', type=int)
+        if width:
+            loop = asyncio.get_running_loop()
+            data = await loop.run_in_executor(thumb_executor, thumbnail, photo_path, width)
+            if data is not None:
+                return Response(data, content_type='image/jpeg')
+        # conditional=True adds ETag/Last-Modified with 304s and Range support
+        return await send_file(photo_path, mimetype='image/jpeg', conditional=True)
     logging.error(f"Photo not found at {photo_path}")
     return {"error": "Photo not found."}, 404
 
@@ -15,6 +15,10 @@ lock = threading.Lock()
 photo_dir = "/home/scanpi/photos"
 os.makedirs(photo_dir, exist_ok=True)
 
+# This app is the only writer, so the latest photo is tracked as it is saved;
+# the folder is listed once at startup instead of every second per client
+latest_photo = max((os.path.join(photo_dir, name) for name in os.listdir(photo_dir)), default=None)
+
 # Function to capture video frames
 def video_stream():
     global video_frame
@@ -28,13 +32,12 @@ def video_stream():
 
 @app.websocket("/ws")
 async def ws():
-    global video_frame
-    latest_photo = None
+    sent = object()  # Matches nothing, so the current state is sent on connect
     while True:
-        if os.path.exists(photo_dir):
-            photos = sorted(os.listdir(photo_dir))
-            latest_photo = os.path.join(photo_dir, photos[-1]) if photos else None
-        await websocket.send_json({"latest_photo": latest_photo})
+        # After that, only send when a new photo has been saved
+        if latest_photo != sent:
+            sent = latest_photo
+            await websocket.send_json({"latest_photo": sent})
         await asyncio.sleep(1)
 
 @app.route("/")
@@ -53,12 +56,14 @@ async def capture():
     global video_frame, lock
     # Use a thread-safe mechanism to avoid locking issues
     def safe_capture():
+        global latest_photo
         with lock:
             if video_frame:
                 timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
                 photo_name = os.path.join(photo_dir, f"photo_{timestamp}.jpg")
                 with open(photo_name, "wb") as f:
                     f.write(video_frame)
+                latest_photo = photo_name
 
     await asyncio.to_thread(safe_capture)
     return "", 204
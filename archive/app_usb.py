@@ -1,8 +1,8 @@
 from quart import Quart, Response, render_template, request, send_file
 import cv2
+import io
 import os
 from datetime import datetime
-from PIL import Image, ExifTags
 import piexif  # Ensure piexif is installed for robust EXIF handling
 import logging
 
@@ -18,6 +18,22 @@ os.makedirs(BASE_PHOTO_DIR, exist_ok=True)
 camera = cv2.VideoCapture(0)  # Use 0 for the default webcam
 
 
+def tag_jpeg(jpeg, tags):
+    """Return JPEG bytes with tags and the capture time in their EXIF block.
+
+    The EXIF block is spliced into the encoded bytes in memory, so tagging
+    costs a copy rather than a decode and a second, lossy encode.
+    """
+    exif_dict = piexif.load(jpeg)
+    stamp = datetime.now().strftime("%Y:%m:%d %H:%M:%S").encode()
+    exif_dict["0th"][piexif.ImageIFD.ImageDescription] = tags.encode('utf-8')
+    exif_dict["0th"][piexif.ImageIFD.XPKeywords] = tuple((tags + "\0").encode('utf-16-le'))
+    exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal] = stamp
+    output = io.BytesIO()
+    piexif.insert(piexif.dump(exif_dict), jpeg, output)
+    return output.getvalue()
+
+
 def generate_frames():
     while True:
         # Capture frame-by-frame
@@ -66,25 +82,23 @@ async def capture_photo():
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         photo_path = os.path.join(folder_path, f'photo_{timestamp}.jpg')
 
-        # Save the photo using OpenCV
-        cv2.imwrite(photo_path, frame)
-        logging.info(f"Photo saved at {photo_path}")
-
+        # Encode once, tag the JPEG bytes in memory and write the file once
+        success, buffer = cv2.imencode('.jpg', frame)
+        if not success:
+            logging.error("Failed to encode photo.")
+            return {"error": "Failed to capture photo."}, 500
         try:
-            # Add metadata (tags) to the photo using piexif
-            exif_dict = piexif.load(photo_path)
-            exif_dict["0th"][piexif.ImageIFD.ImageDescription] = tags.encode('utf-8')
-            exif_bytes = piexif.dump(exif_dict)
-
-            # Save the updated photo with EXIF
-            with Image.open(photo_path) as img:
-                img.save(photo_path, "jpeg", exif=exif_bytes)
-
-            logging.info(f"EXIF metadata updated for {photo_path} with tags: {tags}")
-            return {"message": "Photo captured successfully.", "photo_path": photo_path}, 200
+            jpeg = tag_jpeg(buffer.tobytes(), tags)
+            message = "Photo captured successfully."
         except Exception as e:
             logging.error(f"Failed to add EXIF metadata: {e}")
-            return {"message": "Photo saved, but failed to update EXIF metadata.", "photo_path": photo_path}, 200
+            jpeg = buffer.tobytes()
+            message = "Photo saved, but failed to update EXIF metadata."
+
+        with open(photo_path, 'wb') as f:
+            f.write(jpeg)
+        logging.info(f"Photo saved at {photo_path} with tags: {tags}")
+        return {"message": message, "photo_path": photo_path}, 200
     else:
         logging.error("Failed to capture photo from the camera.")
         return {"error": "Failed to capture photo."}, 500
@@ -95,7 +109,8 @@ async def get_photo(filepath):
     """Serve the captured photo."""
     photo_path = os.path.join(BASE_PHOTO_DIR, filepath)
     if os.path.exists(photo_path):
-        return await send_file(photo_path, mimetype='image/jpeg')
+        # conditional=True adds ETag/Last-Modified with 304s and Range support
+        return await send_file(photo_path, mimetype='image/jpeg', conditional=True)
     logging.error(f"Photo not found at {photo_path}")
     return {"error": "Photo not found."}, 404
 
@@ -1,8 +1,20 @@
 from quart import Quart, websocket, jsonify, render_template
 from picamera2 import Picamera2
 import cv2
-import base64
+import asyncio
 import logging
+import struct
+
+
+# The frame_protocol.py header, inlined so this script runs on its own:
+# magic, version, kind, width, reserved, sequence, timestamp, payload length
+FRAME_HEADER = struct.Struct("<2sBBHxxIQI")
+FRAME_JPEG = 1
+
+
+def pack_jpeg(jpeg, sequence, timestamp, width):
+    """Return jpeg behind a version 1 frame_protocol header."""
+    return FRAME_HEADER.pack(b"PC", 1, FRAME_JPEG, width, sequence & 0xFFFFFFFF, timestamp, len(jpeg)) + jpeg
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -25,6 +37,7 @@ async def index():
 @app.websocket('/video_feed')
 async def video_feed():
     """WebSocket endpoint for streaming video frames."""
+    sequence = 0
     try:
         while True:
             # Capture a frame using the request object
@@ -44,9 +57,10 @@ async def video_feed():
                     logging.warning("Failed to encode lores frame.")
                     continue
 
-                # Convert to Base64 for WebSocket transmission
-                frame_data = base64.b64encode(encoded_frame).decode('utf-8')
-                await websocket.send(frame_data)
+                # Send the raw JPEG as a binary frame_protocol message, no base64
+                sequence += 1
+                timestamp = request.get_metadata().get("SensorTimestamp", 0)
+                await websocket.send(pack_jpeg(encoded_frame.tobytes(), sequence, timestamp, lores_frame.shape[1]))
             finally:
                 # Release the request to avoid memory leaks
                 request.release()
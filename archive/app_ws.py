@@ -1,10 +1,20 @@
 from quart import Quart, websocket, render_template
 from picamera2 import Picamera2
 import cv2
-import base64
 import logging
-from time import sleep
-import cv2
+import struct
+from time import monotonic_ns, sleep
+
+
+# The frame_protocol.py header, inlined so this script runs on its own:
+# magic, version, kind, width, reserved, sequence, timestamp, payload length
+FRAME_HEADER = struct.Struct("<2sBBHxxIQI")
+FRAME_JPEG = 1
+
+
+def pack_jpeg(jpeg, sequence, timestamp, width):
+    """Return jpeg behind a version 1 frame_protocol header."""
+    return FRAME_HEADER.pack(b"PC", 1, FRAME_JPEG, width, sequence & 0xFFFFFFFF, timestamp, len(jpeg)) + jpeg
 
 
 # Configure logging
@@ -39,10 +49,12 @@ async def index():
 @app.websocket('/video_feed')
 async def video_feed():
     """WebSocket endpoint to stream video frames."""
+    sequence = 0
     while True:
         try:
             # Capture a frame
             frame = camera.capture_array()
+            timestamp = monotonic_ns()
             frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
 
             # Encode frame as JPEG
@@ -51,11 +63,9 @@ async def video_feed():
                 logging.warning("Failed to encode frame.")
                 continue
 
-            # Convert to base64 to send over WebSocket
-            frame_data = base64.b64encode(buffer).decode('utf-8')
-
-            # Send the frame over WebSocket
-            await websocket.send(frame_data)
+            # Send the raw JPEG as a binary frame_protocol message, no base64
+            sequence += 1
+            await websocket.send(pack_jpeg(buffer.tobytes(), sequence, timestamp, frame.shape[1]))
         except Exception as e:
             logging.error(f"Error during video feed streaming: {e}")
             break
@@ -0,0 +1,398 @@
+"""Throughput benchmark for the streaming servers.
+
+Runs the capture -> encode -> send path of each server variant against a
+frame source and reports captured and delivered fps, per-stage latency and
+CPU per frame.  The synthetic source is used by default, so no camera is
+needed; each simulated viewer writes into a local socket that is drained by
+a reader thread, so the send stage includes the real kernel copy.
+
+With --encoders it instead times every JPEG encoder backend and setting on
+one frame of the given size, fed in each pixel layout the camera produces.
+With --recording it compares the CPU cost of continuous recording as
+H.264 segments with writing every frame to disk as MJPEG.
+
+    python benchmark.py --duration 10 --clients 4
+    python benchmark.py --variant ws --replay scan.mp4 --encoder simplejpeg
+    python benchmark.py --source picamera2 --json
+    python benchmark.py --encoders --size 1280x960
+    python benchmark.py --recording --size 640x480
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import cv2
+
+from frame_broadcast import FrameBroadcaster
+from frame_hls import LiveHls
+from frame_motion import ChangeGate
+from frame_overlay import Overlay
+from frame_pipeline import FramePipeline
+from frame_recorder import SegmentedRecorder
+from frame_source import Frame, open_source
+from frame_stats import StageStats
+from jpeg_encoders import ENCODERS, create_encoder
+
+
+# Segments the HLS player (templates/live_hls.html) stays behind the newest one
+HLS_HOLD_BACK = 2
+
+# Pipeline and client setup of each server
+VARIANTS = {
+    # app/__init__.py: MJPEG over HTTP, one async generator per client
+    "mjpeg": {"size": (640, 480), "clients": "event"},
+    # app_thread_video_working.py: websocket clients woken once per new frame
+    "ws": {"size": (1280, 960), "gate": True, "clients": "event"},
+    # The same on a still scene (a document on the scan bed), where the change gate skips almost every frame
+    "ws_static": {"size": (1280, 960), "gate": True, "static": True, "clients": "event"},
+    # The same with the timestamp overlay drawn in (?overlay=1)
+    "ws_overlay": {"size": (1280, 960), "gate": True, "overlay": True, "clients": "event"},
+    # app_thread_video_working.py /live: 1 s H.264 segments of the 640 wide stream from the in-memory HLS cache
+    "hls": {"size": (640, 480), "hls": True, "clients": "hls"},
+    # thread_video_roi.py with the centre ROI on, cropped in software and watched on its channel
+    "roi": {"size": (1280, 960), "channel": (0.25, 0.25, 0.5, 0.5), "clients": "event"},
+}
+
+
+class Client:
+    """A simulated viewer whose sends go into a socket drained by a thread."""
+
+    def __init__(self):
+        self.sock, self._peer = socket.socketpair()
+        self.latency = StageStats()
+        self.frames = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.bytes = 0
+        self.last_sequence = 0
+        self._drain = threading.Thread(target=self._drain_peer, daemon=True)
+        self._drain.start()
+
+    def _drain_peer(self):
+        while self._peer.recv(1 << 20):
+            pass
+
+    def record(self, sequence, size, published_at):
+        """Account for one sent frame, published at the given monotonic time."""
+        if sequence == self.last_sequence:
+            self.duplicates += 1
+        else:
+            self.frames += 1
+        self.last_sequence = sequence
+        self.bytes += size
+        self.latency.record(time.monotonic() - published_at)
+
+    def reset(self):
+        self.latency = StageStats()
+        self.frames = self.duplicates = self.dropped = self.bytes = 0
+
+    def close(self):
+        self.sock.close()
+        self._drain.join(timeout=1.0)
+        self._peer.close()
+
+
+async def event_client(broadcaster, client, stop):
+    """Websocket-style loop fed through a latest-frame-wins client queue."""
+    loop = asyncio.get_running_loop()
+    client.sock.setblocking(False)
+    with broadcaster.client() as queue:
+        dropped_before = queue.dropped
+        while not stop.is_set():
+            try:
+                sequence, frame = await asyncio.wait_for(queue.get(), 0.5)
+            except asyncio.TimeoutError:
+                continue
+            published_at = broadcaster.timestamp
+            await loop.sock_sendall(client.sock, frame)
+            client.record(sequence, len(frame), published_at)
+            client.dropped += queue.dropped - dropped_before
+            dropped_before = queue.dropped
+
+
+async def hls_client(hls, client, stop):
+    """HLS player loop: fetch each segment from the cache as soon as the playlist lists it.
+
+    Latency is counted from the capture of the segment's first frame.
+    """
+    loop = asyncio.get_running_loop()
+    client.sock.setblocking(False)
+    with hls.events.client(maxsize=4) as queue:
+        while not stop.is_set():
+            try:
+                _, sequence = await asyncio.wait_for(queue.get(), 0.5)
+            except asyncio.TimeoutError:
+                continue
+            data = hls.segment(sequence)
+            started = hls.started(sequence)
+            if data is None or started is None:
+                client.dropped += 1
+                continue
+            await loop.sock_sendall(client.sock, data)
+            client.record(sequence, len(data), time.monotonic() - (time.time() - started))
+
+
+def start_clients(kind, broadcaster, clients, stop):
+    """Start the client loops for a variant on one event loop thread."""
+    coroutine = {"event": event_client, "hls": hls_client}[kind]
+
+    async def run_all():
+        await asyncio.gather(*(coroutine(broadcaster, client, stop) for client in clients))
+
+    threads = [threading.Thread(target=asyncio.run, args=(run_all(),), daemon=True)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def run_variant(name, source_kind=None, duration=10.0, clients=4, fps=30, warmup=1.0, replay=None,
+                encoder=None):
+    """Benchmark one server variant and return its measurements."""
+    config = VARIANTS[name]
+    options = {"size": config["size"], "fps": fps}
+    if replay:
+        options["path"] = replay
+    elif config.get("static") and source_kind == "synthetic":
+        options["speed"] = 0
+    source = open_source(source_kind, **options)
+    source.start()
+    broadcaster = FrameBroadcaster()
+    hls = LiveHls(fps=fps or 30, software=True) if config.get("hls") else None
+    pipeline = FramePipeline(source, broadcaster, encoder=create_encoder(encoder),
+                             analysers=[hls] if hls else (),
+                             gate=ChangeGate() if config.get("gate") else None,
+                             overlay=Overlay() if config.get("overlay") else None)
+    if hls:
+        hls.start(source)
+        broadcaster = hls
+    if config.get("overlay"):
+        broadcaster = pipeline.rendition(overlay=True)
+    if config.get("channel"):
+        broadcaster = pipeline.set_channel(name, config["channel"])
+    viewers = [Client() for _ in range(clients)]
+    stop = threading.Event()
+    threads = start_clients(config["clients"], broadcaster, viewers, stop)
+    pipeline.start()
+
+    try:
+        time.sleep(warmup)
+        pipeline.reset_stats()
+        for viewer in viewers:
+            viewer.reset()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        time.sleep(duration)
+        cpu = time.process_time() - cpu_start
+        elapsed = time.perf_counter() - wall_start
+        report = pipeline.report()
+    finally:
+        stop.set()
+        if hls:
+            hls.stop()
+        pipeline.stop()
+        for thread in threads:
+            thread.join(timeout=2.0)
+        for viewer in viewers:
+            viewer.close()
+        source.stop()
+
+    send = StageStats()
+    for viewer in viewers:
+        send.count += viewer.latency.count
+        send.total += viewer.latency.total
+        send.max = max(send.max, viewer.latency.max)
+    report["stages"]["send"] = send.as_dict()
+    delivered = sum(viewer.frames for viewer in viewers)
+    if hls:
+        # Each frame reaches a player up to a segment late, and hls.js plays HOLD_BACK segments behind that
+        latency = send.as_dict()["mean_ms"] + HLS_HOLD_BACK * hls.segment_seconds * 1000
+        delivered *= hls.fps * hls.segment_seconds  # Segments, counted in frames
+    else:
+        latency = report["stages"]["encode"]["mean_ms"] + send.as_dict()["mean_ms"]
+    return {
+        "variant": name,
+        "encoder": report["encoder"],
+        "clients": clients,
+        "captured_fps": report["fps"],
+        "delivered_fps": delivered / elapsed / max(clients, 1),
+        "duplicate_fps": sum(viewer.duplicates for viewer in viewers) / elapsed / max(clients, 1),
+        "dropped_fps": sum(viewer.dropped for viewer in viewers) / elapsed / max(clients, 1),
+        "kbytes_per_client_s": sum(viewer.bytes for viewer in viewers) / elapsed / max(clients, 1) / 1024,
+        "producer_cpu_ms_per_frame": report["cpu_ms_per_frame"],
+        "cpu_ms_per_frame": cpu / report["frames"] * 1000 if report["frames"] else 0.0,
+        "latency_ms": latency,
+        "stages": report["stages"],
+        "gate": report["gate"],
+    }
+
+
+def print_table(results):
+    stages = ("capture", "process", "encode", "publish", "send")
+    header = (["variant", "clients", "fps", "delivered", "dupes"] + [f"{s}_ms" for s in stages]
+              + ["cpu_ms/frame", "KB/client/s", "latency_ms", "skipped"])
+    print("  ".join(f"{h:>12}" for h in header))
+    for r in results:
+        row = [r["variant"], r["clients"], f"{r['captured_fps']:.1f}", f"{r['delivered_fps']:.1f}",
+               f"{r['duplicate_fps']:.1f}"]
+        row += [f"{r['stages'][s]['mean_ms']:.2f}" for s in stages]
+        row += [f"{r['cpu_ms_per_frame']:.2f}", f"{r['kbytes_per_client_s']:.0f}", f"{r['latency_ms']:.0f}",
+                r["gate"]["skipped_encodes"] if r["gate"] else "-"]
+        print("  ".join(f"{str(v):>12}" for v in row))
+
+
+def run_encoders(size=(1280, 960), repeat=50, quality=95, source_kind=None, replay=None):
+    """Time each encoder, setting and input layout on one frame of the given size.
+
+    Layouts an encoder cannot take directly are converted first, as the
+    pipeline would, and the conversion is included in the time.
+    """
+    options = {"size": size, "fps": 0}
+    if replay:
+        options["path"] = replay
+    source = open_source(source_kind, **options)
+    source.start()
+    try:
+        frame = source.read()
+    finally:
+        source.stop()
+    inputs = {
+        "BGR": frame,
+        "XBGR8888": cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA),
+        "YUV420": cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420),
+    }
+
+    results = []
+    for name, encoder_class in ENCODERS.items():
+        try:
+            encoder_class()
+        except ImportError as e:
+            print(f"Skipping {name}: {e}")
+            continue
+        for subsampling in ("420", "422", "444"):
+            for fast_dct in (False, True) if name == "simplejpeg" else (False,):
+                encoder = encoder_class(quality=quality, subsampling=subsampling, fast_dct=fast_dct)
+                for fmt, array in inputs.items():
+                    direct = fmt in encoder.formats
+                    if fmt == "YUV420" and direct and subsampling != "420":
+                        continue  # YUV420 planes are always encoded 4:2:0
+                    start = time.perf_counter()
+                    for _ in range(repeat):
+                        if direct:
+                            data = encoder.encode(array, fmt, size[0])
+                        else:
+                            data = encoder.encode(Frame(array, fmt, width=size[0]).bgr())
+                    elapsed = time.perf_counter() - start
+                    results.append({
+                        "encoder": name, "input": fmt, "direct": direct, "subsampling": subsampling,
+                        "fast_dct": fast_dct, "ms_per_frame": elapsed / repeat * 1000, "kbytes": len(data) / 1024,
+                    })
+    return sorted(results, key=lambda r: r["ms_per_frame"])
+
+
+def print_encoder_table(results):
+    header = ["encoder", "input", "direct", "subsampling", "fast_dct", "ms/frame", "KB"]
+    print("  ".join(f"{h:>12}" for h in header))
+    for r in results:
+        row = [r["encoder"], r["input"], r["direct"], r["subsampling"], r["fast_dct"],
+               f"{r['ms_per_frame']:.2f}", f"{r['kbytes']:.1f}"]
+        print("  ".join(f"{str(v):>12}" for v in row))
+
+
+def run_recording(size=(640, 480), duration=10.0, fps=30, source_kind=None, replay=None, encoder=None):
+    """Time reading frames alone, then recording them as MJPEG files and as H.264 segments.
+
+    cpu_ms_per_frame is the process CPU per frame above that of reading
+    alone.  A picamera2 source records on its hardware encoder.
+    """
+    options = {"size": size, "fps": fps}
+    if replay:
+        options["path"] = replay
+    source = open_source(source_kind, **options)
+    source.start()
+    jpeg = create_encoder(encoder)
+    results, baseline = [], 0.0
+    try:
+        for mode in ("read", "mjpeg_disk", "h264_segments"):
+            with tempfile.TemporaryDirectory() as directory:
+                recorder = SegmentedRecorder(directory, fps=fps or 30)
+                if mode == "h264_segments":
+                    recorder.start(source, size)
+                written = frames = 0
+                cpu_start = time.process_time()
+                wall_start = time.perf_counter()
+                with open(os.path.join(directory, "frames.mjpeg"), "wb") as f:
+                    while time.perf_counter() - wall_start < duration:
+                        with source.acquire() as frame:
+                            if mode == "mjpeg_disk":
+                                data = jpeg.encode(frame.bgr())
+                                f.write(data)
+                                written += len(data)
+                            else:
+                                recorder.analyse(frame, frames)
+                        frames += 1
+                recorder.stop()
+                cpu = (time.process_time() - cpu_start) / frames * 1000
+                elapsed = time.perf_counter() - wall_start
+                if mode == "read":
+                    baseline = cpu
+                written += recorder.bytes_written
+                results.append({"mode": mode, "fps": frames / elapsed, "cpu_ms_per_frame": cpu - baseline,
+                                "kbytes_per_s": written / elapsed / 1024, "dropped": recorder.dropped})
+    finally:
+        source.stop()
+    return results
+
+
+def print_recording_table(results):
+    header = ["mode", "fps", "cpu ms/frame", "KB/s", "dropped"]
+    print("  ".join(f"{h:>14}" for h in header))
+    for r in results:
+        row = [r["mode"], f"{r['fps']:.1f}", f"{r['cpu_ms_per_frame']:.2f}", f"{r['kbytes_per_s']:.0f}",
+               r["dropped"]]
+        print("  ".join(f"{str(v):>14}" for v in row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--variant", action="append", choices=sorted(VARIANTS),
+                        help="server variant to run (repeatable, default: all)")
+    parser.add_argument("--source", default="synthetic", help="frame source: synthetic, picamera2 or opencv")
+    parser.add_argument("--replay", help="video file for the synthetic source to replay")
+    parser.add_argument("--fps", type=float, default=30, help="target source frame rate, 0 for unthrottled")
+    parser.add_argument("--clients", type=int, default=4, help="simulated viewers per variant")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per variant")
+    parser.add_argument("--encoder", choices=sorted(ENCODERS), help="JPEG encoder for the pipeline")
+    parser.add_argument("--encoders", action="store_true", help="compare the JPEG encoder backends instead")
+    parser.add_argument("--recording", action="store_true", help="compare H.264 segments with MJPEG to disk instead")
+    parser.add_argument("--size", default="1280x960", help="frame size for --encoders and --recording, WIDTHxHEIGHT")
+    parser.add_argument("--quality", type=int, default=95, help="JPEG quality for --encoders")
+    parser.add_argument("--repeat", type=int, default=50, help="encodes per setting for --encoders")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    if args.encoders:
+        size = tuple(int(v) for v in args.size.lower().split("x"))
+        results = run_encoders(size, args.repeat, args.quality, args.source, args.replay)
+        printer = print_encoder_table
+    elif args.recording:
+        size = tuple(int(v) for v in args.size.lower().split("x"))
+        results = run_recording(size, args.duration, args.fps, args.source, args.replay, args.encoder)
+        printer = print_recording_table
+    else:
+        results = [run_variant(name, args.source, args.duration, args.clients, args.fps, replay=args.replay,
+                               encoder=args.encoder)
+                   for name in args.variant or VARIANTS]
+        printer = print_table
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        printer(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Share one encoded video frame between any number of stream clients."""
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class BroadcasterClosed(Exception):
+    """Raised by FrameClient.get() once its broadcaster has been closed."""
+
+
+class FrameBroadcaster:
+    """Latest-frame holder written by one producer and read by many clients.
+
+    The producer captures and encodes each sensor frame once and calls
+    publish(); every client waits for a frame newer than the last one it
+    sent, so adding viewers adds no captures or encodes.  Threads wait with
+    wait(); coroutines register a FrameClient with client(), which the
+    producer thread feeds through the client's event loop, so a websocket
+    handler wakes exactly once per new frame and a slow one only ever falls
+    behind by its own queue.
+    """
+
+    def __init__(self, condition=None, group=None):
+        self._condition = condition or threading.Condition()
+        self._group = group if group is not None else [self]
+        self.frame = None
+        self.sequence = 0
+        self.timestamp = None
+        # The pipeline's number and the sensor timestamp of the frame published last
+        self.frame_number = None
+        self.frame_timestamp = None
+        self.clients = 0
+        self.closed = False
+        self._async_clients = set()
+        # Siblings share the id sequence so client ids stay unique across renditions
+        self._client_ids = self._group[0]._client_ids if group else itertools.count(1)
+
+    def publish(self, frame, frame_number=None, frame_timestamp=None):
+        """Store a newly encoded frame and wake every waiting client."""
+        with self._condition:
+            self.frame = frame
+            self.sequence += 1
+            self.timestamp = time.monotonic()
+            self.frame_number = frame_number
+            self.frame_timestamp = frame_timestamp
+            self._condition.notify_all()
+            sequence = self.sequence
+            clients = list(self._async_clients)
+        for client in clients:
+            try:
+                client.loop.call_soon_threadsafe(client.offer, sequence, frame)
+            except RuntimeError:
+                # The client's event loop closed while it was disconnecting
+                pass
+
+    def wait(self, last_sequence=0, timeout=None):
+        """Block until a frame newer than last_sequence is available.
+
+        Returns (sequence, frame); frame is None if the timeout expired.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.sequence > last_sequence, timeout):
+                return last_sequence, None
+            return self.sequence, self.frame
+
+    def frame_info(self, sequence):
+        """Return (frame_number, frame_timestamp) of the item published as sequence, or (None, None).
+
+        Only the latest item's are kept; a client sending an older one has
+        fallen behind and gets None.
+        """
+        with self._condition:
+            if self.sequence != sequence:
+                return None, None
+            return self.frame_number, self.frame_timestamp
+
+    def wait_for_clients(self, timeout=None):
+        """Block the producer until any broadcaster in the group has a client."""
+        with self._condition:
+            return self._condition.wait_for(lambda: any(member.clients for member in self._group), timeout)
+
+    def sibling(self):
+        """Return a broadcaster for another rendition of the same stream.
+
+        Siblings share this broadcaster's lock, so wait_for_clients() on any
+        of them wakes as soon as one of them gains a client.
+        """
+        sibling = FrameBroadcaster(self._condition, self._group)
+        self._group.append(sibling)
+        return sibling
+
+    @contextmanager
+    def subscribe(self):
+        """Count the caller as a client for as long as the block runs."""
+        with self._condition:
+            self.clients += 1
+            self._condition.notify_all()
+        try:
+            yield self
+        finally:
+            with self._condition:
+                self.clients -= 1
+
+    @contextmanager
+    def client(self, maxsize=1):
+        """Register a FrameClient on the running event loop for the block."""
+        client = FrameClient(asyncio.get_running_loop(), maxsize, next(self._client_ids))
+        with self._condition:
+            if self.closed:
+                client.close()
+            self._async_clients.add(client)
+            self.clients += 1
+            self._condition.notify_all()
+        try:
+            yield client
+        finally:
+            with self._condition:
+                self._async_clients.discard(client)
+                self.clients -= 1
+            logging.info(f"Client {client.id} disconnected: {client.sent} frames sent, {client.dropped} dropped.")
+
+    def close(self):
+        """Retire this broadcaster: its async clients' get() raises BroadcasterClosed.
+
+        It leaves its sibling group, so its clients no longer keep the
+        producer running.
+        """
+        with self._condition:
+            self.closed = True
+            if self in self._group:
+                self._group.remove(self)
+            clients = list(self._async_clients)
+        for client in clients:
+            try:
+                client.loop.call_soon_threadsafe(client.close)
+            except RuntimeError:
+                pass
+
+    def client_stats(self):
+        """Return sent/dropped counters for every connected async client in the group."""
+        with self._condition:
+            clients = [client for member in self._group for client in member._async_clients]
+        return [client.stats() for client in clients]
+
+
+class FrameClient:
+    """Bounded per-client frame queue where the newest frame always wins.
+
+    The producer offers every published frame; once maxsize frames are
+    waiting the oldest is dropped, so a viewer on a slow link holds at most
+    maxsize frames in memory and always receives the latest one next.
+    """
+
+    def __init__(self, loop, maxsize=1, client_id=0):
+        self.loop = loop
+        self.maxsize = maxsize
+        self.id = client_id
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        self._frames = deque()
+        self._ready = asyncio.Event()
+
+    def offer(self, sequence, frame):
+        """Queue a frame, dropping the oldest one when full (event loop only)."""
+        if len(self._frames) >= self.maxsize:
+            self._frames.popleft()
+            self.dropped += 1
+        self._frames.append((sequence, frame))
+        self._ready.set()
+
+    def close(self):
+        """Wake get() for good; it raises BroadcasterClosed once the queue is empty (event loop only)."""
+        self.closed = True
+        self._ready.set()
+
+    async def get(self):
+        """Wait for and return the next (sequence, frame) to send."""
+        while not self._frames:
+            if self.closed:
+                raise BroadcasterClosed()
+            self._ready.clear()
+            await self._ready.wait()
+        return self._frames.popleft()
+
+    def stats(self):
+        return {"id": self.id, "sent": self.sent, "dropped": self.dropped, "queued": len(self._frames)}
@@ -0,0 +1,218 @@
+"""H.264 from the Pi's hardware encoder, or from libx264 where there is none.
+
+H264Feed is the base of everything that consumes an encoded stream
+(SegmentedRecorder on disk, LiveHls in memory): start(source) attaches
+Picamera2's H264Encoder to the running camera when the source has one and
+the Pi has an encoder block, with a custom Output that hands every access
+unit to write(), and otherwise encodes frames taken from the pipeline
+with libx264 through PyAV on a thread of its own.  The Pi 5 has no
+H.264 hardware, so it always takes the libx264 path.  Either way keyframes arrive every
+keyframe_seconds, with the SPS/PPS repeated, so a segment cut at any
+keyframe plays on its own.
+"""
+import logging
+import queue
+import threading
+import time
+from fractions import Fraction
+
+import cv2
+
+from frame_stats import StageStats
+
+MICROSECONDS = Fraction(1, 1000000)
+
+
+def hardware_h264():
+    """True where Picamera2 runs on a Pi with an H.264 encoder block; the Pi 5 (PiSP) has none."""
+    try:
+        from picamera2.platform import Platform, get_platform
+    except ImportError:
+        return True  # Older Picamera2 releases only run on the Pi 4 and earlier
+    return get_platform() == Platform.VC4
+
+
+def _picamera2_output(feed):
+    """Return a Picamera2 Output that hands every encoded frame to feed."""
+    from picamera2.outputs import Output
+
+    class FeedOutput(Output):
+        def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+            feed.write(frame, keyframe, timestamp)
+
+    return FeedOutput()
+
+
+def open_container(file, size, fps, format="mpegts"):
+    """Open a container on file (a path or file object) with one H.264 stream of size; return both."""
+    import av
+
+    container = av.open(file, "w", format=format)
+    stream = container.add_stream("h264", rate=fps)
+    stream.width, stream.height = size
+    return container, stream
+
+
+def mux(container, stream, data, keyframe, timestamp):
+    """Mux one encoded access unit, timestamp in microseconds, without re-encoding it."""
+    import av
+
+    packet = av.Packet(data)
+    packet.stream = stream
+    packet.time_base = MICROSECONDS
+    packet.pts = packet.dts = timestamp
+    packet.is_keyframe = keyframe
+    container.mux(packet)
+
+
+class H264Feed:
+    """An H.264 encoder feeding write(data, keyframe, timestamp), which subclasses implement.
+
+    A Picamera2Source on a Pi with an H.264 block is encoded in hardware
+    from stream ("main" or "lores"); any other source, a Pi 5, or
+    software=True goes through the pipeline, which then has to list the
+    feed among its analysers.  bitrate is in
+    bits per second.
+    """
+
+    def __init__(self, keyframe_seconds=1.0, fps=30, bitrate=4000000, stream="main", software=False):
+        self.keyframe_seconds = keyframe_seconds
+        self.fps = fps
+        self.bitrate = bitrate
+        self.stream = stream
+        self.software = software
+        self.mode = None
+        self.running = False
+        self.size = None
+        self.dropped = 0
+        self.encode_stats = StageStats()
+        self.encode_cpu = 0.0
+        self.last_error = None
+        self._frames = queue.Queue(maxsize=fps)
+        self._thread = None
+        self._source = None
+        self._encoder = None
+
+    @property
+    def enabled(self):
+        """True while frames from the pipeline are being encoded in software."""
+        return self.running and self.mode == "software"
+
+    def start_encoder(self, source, size=None):
+        """Start encoding source; size is the software encoder's frame size (default the frame's)."""
+        if self.running:
+            return
+        self._source = source
+        self.running = True
+        picam2 = getattr(source, "picam2", None)
+        if picam2 is not None and not self.software and hardware_h264():
+            from picamera2.encoders import H264Encoder
+
+            self.mode = "hardware"
+            self.size = tuple(picam2.camera_config[self.stream]["size"])
+            self._encoder = H264Encoder(bitrate=self.bitrate, repeat=True,
+                                        iperiod=max(int(self.fps * self.keyframe_seconds), 1))
+            picam2.start_encoder(self._encoder, _picamera2_output(self), name=self.stream)
+        else:
+            self.mode = "software"
+            self.size = None
+            self._thread = threading.Thread(target=self._encode_frames, args=(size,), daemon=True)
+            self._thread.start()
+
+    def stop_encoder(self):
+        if not self.running:
+            return
+        self.running = False
+        if self.mode == "hardware":
+            self._source.picam2.stop_encoder(self._encoder)
+        elif self._thread is not None:
+            self._frames.put(None)
+            self._thread.join(timeout=5.0)
+            self._thread = None
+
+    def analyse(self, frame, sequence):
+        """Queue a copy of a pipeline frame for the software encoder; dropped if it falls behind."""
+        if not self.enabled:
+            return
+        stream = frame.lores if frame.lores is not None else frame
+        try:
+            self._frames.put_nowait((stream.array.copy(), stream.fmt, stream.width, frame.timestamp))
+        except queue.Full:
+            self.dropped += 1
+
+    def _encode_frames(self, size):
+        import av
+        from av.video.frame import PictureType
+
+        context = None
+        last_keyframe = None
+        while True:
+            item = self._frames.get()
+            if item is None:
+                break
+            array, fmt, width, timestamp = item
+            cpu_start = time.thread_time()
+            start = time.perf_counter()
+            try:
+                image, to_yuv = None, cv2.COLOR_BGR2YUV_I420
+                if fmt == "YUV420":
+                    height = array.shape[0] * 2 // 3
+                    if array.shape[1] == width and (not size or size == (width, height)):
+                        yuv = array
+                    else:
+                        image = cv2.cvtColor(array, cv2.COLOR_YUV2BGR_I420)[:, :width]
+                else:
+                    image = array[:, :width, :3]
+                    if fmt in ("BGR888", "XBGR8888"):
+                        to_yuv = cv2.COLOR_RGB2YUV_I420
+                if image is not None:
+                    # Scaled before the colour conversion, which then touches only the smaller image
+                    if size and size != (image.shape[1], image.shape[0]):
+                        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+                    height, width = image.shape[:2]
+                    yuv = cv2.cvtColor(image, to_yuv)
+                if context is None:
+                    self.size = (width, height)
+                    context = av.CodecContext.create("libx264", "w")
+                    context.width, context.height = width, height
+                    context.pix_fmt = "yuv420p"
+                    context.time_base = MICROSECONDS
+                    context.framerate = Fraction(self.fps)
+                    context.bit_rate = self.bitrate
+                    # A backstop; keyframes are forced below
+                    context.gop_size = max(int(self.fps * self.keyframe_seconds * 2), 1)
+                    context.options = {"preset": "ultrafast", "tune": "zerolatency",
+                                       "x264-params": "repeat-headers=1:scenecut=0"}
+                video_frame = av.VideoFrame.from_ndarray(yuv, format="yuv420p")
+                video_frame.pts = timestamp // 1000
+                video_frame.time_base = MICROSECONDS
+                # Keyframes by the clock, so segments keep their length when the frame rate drops
+                if last_keyframe is None or self.keyframe_due(last_keyframe, video_frame.pts):
+                    video_frame.pict_type = PictureType.I
+                    last_keyframe = video_frame.pts
+                for packet in context.encode(video_frame):
+                    self.write(bytes(packet), packet.is_keyframe, packet.pts)
+            except Exception as e:
+                self.last_error = str(e)
+                logging.error(f"Failed to encode H.264 frame: {e}")
+            self.encode_stats.record(time.perf_counter() - start)
+            self.encode_cpu += time.thread_time() - cpu_start
+
+    def keyframe_due(self, first, timestamp):
+        """True once timestamp is a keyframe interval after first, both in microseconds.
+
+        The hardware encoder puts a keyframe every fps * keyframe_seconds
+        frames, which at a slightly fast sensor clock span a little less
+        than keyframe_seconds, so half a frame short still counts.
+        """
+        return timestamp - first >= self.keyframe_seconds * 1000000 - 500000 / self.fps
+
+    def write(self, data, keyframe, timestamp):
+        """Take one encoded access unit, timestamp in microseconds."""
+        raise NotImplementedError
+
+    def encoder_status(self):
+        frames = self.encode_stats.count
+        return {"mode": self.mode, "size": self.size, "bitrate": self.bitrate, "dropped": self.dropped,
+                "last_error": self.last_error, "encode": self.encode_stats.as_dict(),
+                "encode_cpu_ms_per_frame": self.encode_cpu / frames * 1000 if frames else 0.0}
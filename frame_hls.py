@@ -0,0 +1,190 @@
+"""Live HLS for browsers, served from a small in-memory cache of H.264 segments.
+
+A browser cannot play raw H.264 from a websocket, and MJPEG sends every
+frame as a full JPEG.  LiveHls runs one H.264 encoder (see frame_h264),
+cuts its output at keyframes into short MPEG-TS segments and keeps the
+last few in memory, so however many viewers play the stream it is encoded
+once and every segment request is a lookup among a few cached segments.  Nothing touches
+the SD card.
+
+The playlist advertises blocking reloads (the LL-HLS _HLS_msn parameter):
+a player asks for the next playlist before its segment exists and is
+answered the moment it does, instead of polling, which takes most of a
+segment off the latency; one more than two segments ahead of the newest
+is refused, as the LL-HLS spec asks.  The encoder runs only while the
+playlist is being requested and stops idle_timeout seconds after the last
+viewer goes.
+"""
+import io
+import logging
+import math
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from frame_broadcast import FrameBroadcaster
+from frame_h264 import H264Feed, mux, open_container
+from frame_stats import StageStats
+
+
+class LiveHls(H264Feed):
+    """HLS playlist and segments of the last segments * segment_seconds of video.
+
+    Viewers are counted by the name passed to touch() over the last
+    VIEWER_WINDOW seconds.  events publishes the media sequence number of
+    each segment as it is finished, for blocking playlist reloads.
+    """
+
+    VIEWER_WINDOW = 10.0
+
+    def __init__(self, segment_seconds=1.0, segments=6, fps=30, bitrate=1500000, stream="lores", software=False,
+                 idle_timeout=30.0):
+        super().__init__(segment_seconds, fps, bitrate, stream, software)
+        self.segment_seconds = segment_seconds
+        self.idle_timeout = idle_timeout
+        self.events = FrameBroadcaster()
+        # (media sequence, wall time of the first frame, duration, data), oldest first
+        self._segments = deque(maxlen=segments)
+        self._sequence = 0
+        self._current = None
+        self._lock = threading.Lock()
+        # Serialises start() and stop(), which the request handlers and the idle watchdog both call
+        self._state_lock = threading.Lock()
+        self._viewers = {}
+        self._last_request = 0.0
+        self._watchdog = None
+        self.playlist_requests = 0
+        self.segment_requests = 0
+        self.bytes_served = 0
+        self.publish_lag = StageStats()
+
+    def start(self, source, size=None):
+        """Start encoding source if it is not running yet; see H264Feed for size."""
+        with self._state_lock:
+            self._last_request = time.monotonic()
+            if self.running:
+                return
+            self.start_encoder(source, size)
+            self._watchdog = threading.Thread(target=self._stop_when_idle, daemon=True)
+            self._watchdog.start()
+        logging.info(f"Live HLS started ({self.mode} H.264, {self.segment_seconds:g} s segments)")
+
+    def stop(self):
+        """Stop encoding and empty the cache, which would be stale by the next start."""
+        with self._state_lock:
+            self._stop()
+
+    def _stop(self):
+        if not self.running:
+            return
+        self.stop_encoder()
+        with self._lock:
+            if self._current is not None:
+                self._current["container"].close()
+                self._current = None
+            self._segments.clear()
+        logging.info("Live HLS stopped")
+
+    def _stop_when_idle(self):
+        # A watchdog left over from an earlier start() ends once a newer one has taken over
+        while self.running and self._watchdog is threading.current_thread():
+            time.sleep(1.0)
+            with self._state_lock:
+                # Checked under the lock, so a start() that has just touched the stream keeps it
+                idle = time.monotonic() - self._last_request > self.idle_timeout
+                if idle and self._watchdog is threading.current_thread():
+                    self._stop()
+
+    def touch(self, viewer):
+        """Note a request from viewer (a client address, say), keeping the encoder running."""
+        now = time.monotonic()
+        self._last_request = now
+        self._viewers[viewer] = now
+
+    @property
+    def viewers(self):
+        since = time.monotonic() - self.VIEWER_WINDOW
+        for viewer, seen in list(self._viewers.items()):
+            if seen < since:
+                self._viewers.pop(viewer, None)
+        return len(self._viewers)
+
+    def write(self, data, keyframe, timestamp):
+        """Add one encoded access unit, finishing the segment on a due keyframe."""
+        with self._lock:
+            current = self._current
+            if keyframe and (current is None or self.keyframe_due(current["first"], timestamp)):
+                self._finish_segment()
+                buffer = io.BytesIO()
+                container, stream = open_container(buffer, self.size, self.fps)
+                current = self._current = {"buffer": buffer, "container": container, "stream": stream,
+                                           "started": time.time(), "first": timestamp, "last": timestamp}
+            if current is None:
+                return  # Wait for the first keyframe
+            mux(current["container"], current["stream"], data, keyframe, timestamp)
+            current["last"] = timestamp
+
+    def _finish_segment(self):
+        current, self._current = self._current, None
+        if current is None:
+            return
+        current["container"].close()
+        duration = (current["last"] - current["first"]) / 1000000 + 1 / self.fps
+        self._segments.append((self._sequence, current["started"], duration, current["buffer"].getvalue()))
+        # How long the segment's first frame waited before a player could fetch it
+        self.publish_lag.record(time.time() - current["started"])
+        self.events.publish(self._sequence)
+        self._sequence += 1
+
+    def has(self, sequence):
+        """True once the segment with media sequence number sequence is finished."""
+        return sequence < self._sequence
+
+    def too_far(self, sequence):
+        """True if sequence is more than two segments past the newest finished one."""
+        return sequence > self._sequence + 1
+
+    def playlist(self):
+        """Return the live media playlist (m3u8 text) of the cached segments."""
+        with self._lock:
+            segments = list(self._segments)
+        target = max([round(duration) for _, _, duration, _ in segments] + [math.ceil(self.segment_seconds)])
+        lines = ["#EXTM3U", "#EXT-X-VERSION:6", f"#EXT-X-TARGETDURATION:{target}",
+                 "#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES",
+                 f"#EXT-X-MEDIA-SEQUENCE:{segments[0][0] if segments else self._sequence}"]
+        for sequence, started, duration, _ in segments:
+            # Lets the player work out glass-to-glass latency from the wall clock
+            program_time = datetime.fromtimestamp(started, timezone.utc).isoformat(timespec="milliseconds")
+            lines += [f"#EXT-X-PROGRAM-DATE-TIME:{program_time}", f"#EXTINF:{duration:.3f},", f"{sequence}.ts"]
+        self.playlist_requests += 1
+        return "\n".join(lines) + "\n"
+
+    def segment(self, sequence):
+        """Return the data of a cached segment, or None once it has left the cache."""
+        with self._lock:
+            for cached, _, _, data in self._segments:
+                if cached == sequence:
+                    self.segment_requests += 1
+                    self.bytes_served += len(data)
+                    return data
+        return None
+
+    def started(self, sequence):
+        """Return the wall time of a cached segment's first frame, or None once it has left the cache."""
+        with self._lock:
+            for cached, started, _, _ in self._segments:
+                if cached == sequence:
+                    return started
+        return None
+
+    def status(self):
+        with self._lock:
+            cached = len(self._segments)
+            cache_bytes = sum(len(data) for _, _, _, data in self._segments)
+            seconds = sum(duration for _, _, duration, _ in self._segments)
+        return {"running": self.running, "viewers": self.viewers, "segments": cached, "cache_bytes": cache_bytes,
+                "sequence": self._sequence, "kbytes_per_viewer_s": cache_bytes / seconds / 1024 if seconds else 0.0,
+                "playlist_requests": self.playlist_requests, "segment_requests": self.segment_requests,
+                "bytes_served": self.bytes_served, "publish_lag": self.publish_lag.as_dict(),
+                **self.encoder_status()}
@@ -0,0 +1,139 @@
+"""Results of the IMX500's on-sensor neural network, read inside the frame pipeline.
+
+The IMX500 runs its network on the sensor and returns the output tensors
+in the metadata of the same request as the image, so reading them costs no
+extra capture and no model run on the Pi: the pipeline hands each acquired
+frame to Imx500Inference.analyse(), which decodes the tensors with a few
+NumPy operations and publishes compact JSON on events, tagged with the
+pipeline's frame sequence number and the sensor timestamp so clients can
+match results to video frames.
+
+The IMX500 firmware has to be loaded before the camera is opened, so
+create Imx500Inference first and open the source on its picam2.
+"""
+import json
+import logging
+import time
+
+import numpy as np
+
+from frame_broadcast import FrameBroadcaster
+from frame_stats import StageStats
+
+
+def top_k(scores, k, threshold=0.0):
+    """Return (indices, scores) of the k highest scores above threshold, best first."""
+    k = min(k, scores.size)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp), scores[:0]
+    indices = np.argpartition(-scores, k - 1)[:k]
+    indices = indices[np.argsort(-scores[indices])]
+    indices = indices[scores[indices] >= threshold]
+    return indices, scores[indices]
+
+
+def softmax(values):
+    exp = np.exp(values - values.max())
+    return exp / exp.sum()
+
+
+class Imx500Inference:
+    """Decode the IMX500's classification or detection outputs for FramePipeline's analysers.
+
+    model_path is a .rpk network package.  Labels and the output layout come
+    from its network intrinsics, unless labels (a list, or a file with one
+    label per line) or task ("classification" or "object detection") are
+    given.  Classification results are the top_k classes scoring at least
+    threshold; detections keep at most max_detections boxes scoring at
+    least threshold, as normalised (x, y, w, h) of the main stream.
+
+    enabled is true while a client listens on events, which keeps the
+    pipeline reading frames for them; frames the pipeline reads anyway are
+    always decoded, so latest stays current for other consumers.
+    """
+
+    def __init__(self, model_path, labels=None, task=None, top_k=3, threshold=0.5, max_detections=10):
+        from picamera2 import Picamera2
+        from picamera2.devices.imx500 import IMX500, NetworkIntrinsics
+
+        self.imx500 = IMX500(model_path)
+        intrinsics = self.imx500.network_intrinsics or NetworkIntrinsics()
+        if task:
+            intrinsics.task = task
+        if isinstance(labels, str):
+            with open(labels) as f:
+                labels = f.read().splitlines()
+        if labels:
+            intrinsics.labels = labels
+        intrinsics.update_with_defaults()
+        self.intrinsics = intrinsics
+        self.task = intrinsics.task
+        self.labels = [label for label in intrinsics.labels or []
+                       if not (getattr(intrinsics, "ignore_dash_labels", False) and label in ("-", ""))]
+        self.top_k = top_k
+        self.threshold = threshold
+        self.max_detections = max_detections
+        # Opened on the IMX500's camera with the network firmware already loaded
+        self.picam2 = Picamera2(self.imx500.camera_num)
+        self.events = FrameBroadcaster()
+        self.decode_stats = StageStats()
+        self.results = 0
+        self.latest = None
+        logging.info(f"IMX500 {self.task} network loaded from {model_path}")
+
+    @property
+    def enabled(self):
+        return self.events.clients > 0
+
+    def _label(self, index):
+        index = int(index)
+        return self.labels[index] if index < len(self.labels) else str(index)
+
+    def _classify(self, outputs):
+        scores = outputs[0][0].astype(np.float32).ravel()
+        if getattr(self.intrinsics, "softmax", False):
+            scores = softmax(scores)
+        indices, best = top_k(scores, self.top_k, self.threshold)
+        return {"classes": [{"label": self._label(i), "score": round(float(s), 4)} for i, s in zip(indices, best)]}
+
+    def _detect(self, outputs, metadata):
+        boxes, scores, classes = outputs[0][0], outputs[1][0].ravel(), outputs[2][0].ravel()
+        keep, best = top_k(scores, self.max_detections, self.threshold)
+        boxes = boxes[keep].astype(np.float32)
+        if getattr(self.intrinsics, "bbox_normalization", False):
+            boxes /= self.imx500.get_input_size()[1]
+        if getattr(self.intrinsics, "bbox_order", "yx") == "xy":
+            boxes = boxes[:, [1, 0, 3, 2]]
+        # Boxes are (y0, x0, y1, x1) of the network input; map the few kept ones onto the main stream
+        width, height = self.picam2.camera_config["main"]["size"]
+        detections = []
+        for box, score, index in zip(boxes, best, classes[keep]):
+            x, y, w, h = (float(v) for v in self.imx500.convert_inference_coords(tuple(box), metadata, self.picam2))
+            detections.append({"label": self._label(index), "score": round(float(score), 4),
+                               "box": [round(x / width, 4), round(y / height, 4),
+                                       round(w / width, 4), round(h / height, 4)]})
+        return {"detections": detections}
+
+    def analyse(self, frame, sequence):
+        """Decode the network outputs carried by frame's metadata, if it has any."""
+        start = time.perf_counter()
+        outputs = self.imx500.get_outputs(frame.metadata, add_batch=True)
+        if outputs is None:
+            return  # The network runs slower than the stream; this frame carries no result
+        if self.task == "classification":
+            result = self._classify(outputs)
+        else:
+            result = self._detect(outputs, frame.metadata)
+        kpi = self.imx500.get_kpi_info(frame.metadata)
+        result = {"type": "inference", "task": self.task, "sequence": sequence, "timestamp": frame.timestamp,
+                  **result}
+        if kpi:
+            result["dnn_ms"], result["dsp_ms"] = kpi
+        self.latest = result
+        self.results += 1
+        self.decode_stats.record(time.perf_counter() - start)
+        self.events.publish(json.dumps(result))
+
+    def as_dict(self):
+        return {"task": self.task, "labels": len(self.labels), "top_k": self.top_k, "threshold": self.threshold,
+                "results": self.results, "decode": self.decode_stats.as_dict(), "latest": self.latest}
@@ -0,0 +1,277 @@
+"""Motion detection on the video stream, run inside the frame pipeline.
+
+Each analysed frame is reduced to a small greyscale image (the lores
+stream's Y plane when the camera has one, so there is no colour conversion
+at all), compared with a slowly adapting background, and the share of
+changed pixels is measured in every zone.  The whole comparison is a few
+vectorised OpenCV calls on a 160-pixel-wide image, so it costs a fraction
+of a millisecond per frame whatever the stream resolution.
+
+Motion starting and stopping is published as JSON on events, a
+FrameBroadcaster of its own, and can call on_trigger (to capture a full
+resolution still, say) at most once per cooldown.
+
+ChangeGate uses the same reduction to tell the pipeline when a frame looks
+just like the last one it sent, so a static scene is not encoded and
+shipped again 30 times a second.
+"""
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from frame_broadcast import FrameBroadcaster
+from frame_stats import StageStats
+from frame_roi import FULL_VIEW, parse_rect
+
+SETTINGS = ("enabled", "threshold", "min_area", "learning_rate", "cooldown", "max_fps", "trigger")
+
+
+def small_grey(frame, width):
+    """Return a greyscale image of frame width pixels wide, from its lores stream when it has one."""
+    stream = frame.lores if frame.lores is not None else frame
+    stream_width, height = stream.size
+    small = (width, max(round(height * width / stream_width), 1))
+    # Skip rows and columns down to about twice the target size before averaging the rest
+    step = max(stream_width // (width * 2), 1)
+    if stream.fmt == "YUV420":
+        # The Y plane is the greyscale image already
+        return cv2.resize(stream.array[:height:step, :stream_width:step], small, interpolation=cv2.INTER_AREA)
+    # Shrink first so the colour conversion only touches the small image
+    image = cv2.resize(stream.array[::step, :stream_width:step], small, interpolation=cv2.INTER_AREA)
+    if stream.fmt in ("BGR888", "XBGR8888"):
+        return cv2.cvtColor(image, cv2.COLOR_RGBA2GRAY if image.shape[2] == 4 else cv2.COLOR_RGB2GRAY)
+    return cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+
+
+class MotionDetector:
+    """Background-subtraction motion detector for FramePipeline's analysers.
+
+    threshold is the grey-level change (0-255) that marks a pixel as
+    changed, and a zone (a normalised (x, y, w, h) of the view) is in
+    motion once min_area of its pixels have changed.  learning_rate sets
+    how fast the background absorbs slow changes such as daylight.  Frames
+    are analysed at most max_fps times a second, the rest are skipped
+    untouched.  on_trigger(event) runs on a worker thread of its own, since
+    the pipeline thread holds the camera buffer, and only while trigger is
+    set.
+    """
+
+    def __init__(self, width=160, threshold=25, min_area=0.01, zones=None, learning_rate=0.05,
+                 cooldown=10.0, max_fps=10.0, hold=1.0, on_trigger=None, trigger=False, enabled=True):
+        self.width = width
+        self.threshold = threshold
+        self.min_area = min_area
+        self.learning_rate = learning_rate
+        self.cooldown = cooldown
+        self.max_fps = max_fps
+        self.hold = hold
+        self.on_trigger = on_trigger
+        self.trigger = trigger
+        self.enabled = enabled
+        self.events = FrameBroadcaster()
+        self.analyse_stats = StageStats()
+        self.cpu_time = 0.0
+        self.started_at = time.perf_counter()
+        self.moving = False
+        self.scores = {}
+        self.triggered = 0
+        self._background = None
+        self._bounds = None
+        self._last_analysed = 0.0
+        self._last_motion = 0.0
+        self._last_trigger = float("-inf")
+        self._triggering = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="motion-trigger")
+        self.set_zones(zones)
+
+    @staticmethod
+    def parse_zones(zones):
+        """Return a validated dict of name -> rect; None watches the whole view, anything but a dict is a ValueError."""
+        if zones is None:
+            zones = {"all": FULL_VIEW}
+        if not isinstance(zones, dict):
+            raise ValueError("zones must be an object of name: rect.")
+        return {name: parse_rect(rect) for name, rect in zones.items()}
+
+    def set_zones(self, zones=None):
+        """Replace the zones with a dict of name -> rect; None watches the whole view."""
+        # One assignment, which analyse() picks up whole on its next frame
+        self.zones = self.parse_zones(zones)
+
+    def configure(self, **settings):
+        """Change any of SETTINGS (and zones); ValueError for an unknown or invalid one.
+
+        Every value is checked before any is applied, so a bad one changes nothing.
+        """
+        unknown = set(settings) - set(SETTINGS) - {"zones"}
+        if unknown:
+            raise ValueError(f"Unknown motion settings: {', '.join(sorted(unknown))}")
+        updates = {}
+        for name, value in settings.items():
+            if name == "zones":
+                value = self.parse_zones(value)
+            elif name in ("enabled", "trigger"):
+                if not isinstance(value, bool):
+                    raise ValueError(f"{name} must be true or false.")
+            else:
+                if isinstance(value, bool):
+                    raise ValueError(f"{name} must be a number.")
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    raise ValueError(f"{name} must be a number.")
+                if value < 0:
+                    raise ValueError(f"{name} must not be negative.")
+            updates[name] = value
+        for name, value in updates.items():
+            setattr(self, name, value)
+        if not self.enabled:
+            self._background = None
+            self.moving = False
+
+    @staticmethod
+    def _zone_bounds(zones, shape):
+        height, width = shape
+        bounds = {}
+        for name, (x, y, w, h) in zones.items():
+            left, top = int(x * width), int(y * height)
+            right, bottom = max(int((x + w) * width), left + 1), max(int((y + h) * height), top + 1)
+            bounds[name] = (slice(top, bottom), slice(left, right), (bottom - top) * (right - left))
+        return bounds
+
+    def analyse(self, frame, sequence):
+        """Compare frame with the background; called by the pipeline with each captured frame."""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if self.max_fps and now - self._last_analysed < 1.0 / self.max_fps:
+            return
+        self._last_analysed = now
+        cpu_start = time.thread_time()
+        start = time.perf_counter()
+
+        grey = small_grey(frame, self.width)
+        if self._background is None or self._background.shape != grey.shape:
+            self._background = grey.astype(np.float32)
+            return
+        # Only this thread writes _bounds; a zone update is seen as a new zones dict
+        zones = self.zones
+        if self._bounds is None or self._bounds[0] is not zones or self._bounds[1] != grey.shape:
+            self._bounds = (zones, grey.shape, self._zone_bounds(zones, grey.shape))
+        diff = cv2.absdiff(grey, cv2.convertScaleAbs(self._background))
+        cv2.accumulateWeighted(grey, self._background, self.learning_rate)
+        _, changed = cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY)
+        self.scores = {name: cv2.countNonZero(changed[rows, cols]) / area
+                       for name, (rows, cols, area) in self._bounds[2].items()}
+        active = sorted(name for name, score in self.scores.items() if score >= self.min_area)
+
+        event = None
+        if active:
+            self._last_motion = now
+            if not self.moving:
+                self.moving = True
+                event = self._event("start", sequence, frame.timestamp, active)
+            if self.trigger and self.on_trigger and now - self._last_trigger >= self.cooldown:
+                self._fire(event or self._event("motion", sequence, frame.timestamp, active))
+        elif self.moving and now - self._last_motion >= self.hold:
+            self.moving = False
+            event = self._event("end", sequence, frame.timestamp, active)
+
+        self.analyse_stats.record(time.perf_counter() - start)
+        self.cpu_time += time.thread_time() - cpu_start
+        if event is not None:
+            self.publish(event)
+
+    def _event(self, state, sequence, timestamp, active):
+        return {"type": "motion", "state": state, "sequence": sequence, "timestamp": timestamp,
+                "time": time.time(), "zones": active,
+                "scores": {name: round(score, 4) for name, score in self.scores.items()}}
+
+    def _fire(self, event):
+        """Run on_trigger on the worker unless the previous trigger is still running."""
+        if not self._triggering.acquire(blocking=False):
+            return
+        self._last_trigger = time.monotonic()
+        self.triggered += 1
+
+        def run():
+            try:
+                self.on_trigger(event)
+            except Exception as e:
+                logging.error(f"Motion trigger failed: {e}")
+            finally:
+                self._triggering.release()
+
+        self._executor.submit(run)
+
+    def publish(self, event):
+        """Send an event dict to every events client as JSON."""
+        self.events.publish(json.dumps(event))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def as_dict(self):
+        """Return the settings, zones, current state and cost so far."""
+        elapsed = time.perf_counter() - self.started_at
+        return {
+            **{name: getattr(self, name) for name in SETTINGS},
+            "zones": self.zones,
+            "moving": self.moving,
+            "scores": self.scores,
+            "triggered": self.triggered,
+            "analyse": self.analyse_stats.as_dict(),
+            # Share of one core spent on motion detection since start
+            "core_fraction": self.cpu_time / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class ChangeGate:
+    """Decides whether a frame differs enough from the last one sent to be worth encoding.
+
+    Frames are compared as width-pixel greyscale images, so each pixel is
+    the average of a block of the stream and sensor noise cancels out; a
+    frame passes once any block has changed by more than threshold grey
+    levels, or keepalive seconds after the last frame that passed, so
+    clients still see the stream is alive.
+    """
+
+    def __init__(self, width=64, threshold=6, keepalive=1.0, enabled=True):
+        self.width = width
+        self.threshold = threshold
+        self.keepalive = keepalive
+        self.enabled = enabled
+        self.passed = 0
+        self.skipped = 0
+        self.check_stats = StageStats()
+        self._reference = None
+        self._passed_at = float("-inf")
+
+    def changed(self, frame):
+        """Return True if frame should be encoded and sent, recording it as the new reference."""
+        if not self.enabled:
+            return True
+        start = time.perf_counter()
+        grey = small_grey(frame, self.width)
+        now = time.monotonic()
+        changed = (self._reference is None or self._reference.shape != grey.shape
+                   or now - self._passed_at >= self.keepalive
+                   or cv2.norm(grey, self._reference, cv2.NORM_INF) > self.threshold)
+        if changed:
+            # Compared with the last frame sent, not the previous one, so a slow drift still gets through
+            self._reference = grey
+            self._passed_at = now
+            self.passed += 1
+        else:
+            self.skipped += 1
+        self.check_stats.record(time.perf_counter() - start)
+        return changed
+
+    def as_dict(self):
+        return {"enabled": self.enabled, "threshold": self.threshold, "keepalive": self.keepalive,
+                "passed": self.passed, "skipped": self.skipped, "check": self.check_stats.as_dict()}
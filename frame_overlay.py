@@ -0,0 +1,159 @@
+"""Annotations burned into the outgoing video, drawn once per encoded rendition.
+
+Drawing boxes and labels per viewer (like the cv2.putText call in
+archive/app_photo.py, repeated for each client) makes every extra viewer
+cost a copy and a redraw.  Overlay instead runs in the frame pipeline: it
+collects the motion and IMX500 results of each frame once, and the
+pipeline draws them onto the overlaid renditions it encodes, so a hundred
+viewers of one rendition share one drawing.
+
+Text is composed from glyph bitmaps rendered once per character, and boxes
+and glyphs are painted with array slicing and masks, so a frame's overlay
+is a handful of NumPy assignments rather than a putText per label.
+Viewers that would rather draw in the browser take the clean stream and
+the same annotations as JSON from events.
+"""
+import json
+import string
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from frame_broadcast import FrameBroadcaster
+from frame_stats import StageStats
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+MOTION_COLOUR = (0, 0, 255)
+DETECTION_COLOUR = (0, 255, 0)
+TEXT_COLOUR = (255, 255, 255)
+LABEL_BACKGROUND = (0, 0, 0)
+
+
+class GlyphCache:
+    """Boolean masks of text in one font size, built from per-character bitmaps."""
+
+    def __init__(self, scale=0.5, thickness=1, max_texts=256):
+        self.scale = scale
+        self.thickness = thickness
+        self.max_texts = max_texts
+        (_, height), baseline = cv2.getTextSize("Ag", FONT, scale, thickness)
+        self.height = height + baseline + 2
+        self._baseline = baseline + 1
+        self._glyphs = {}
+        self._texts = OrderedDict()
+        # Rendered up front so the first annotated frame costs no more than the rest
+        for char in string.printable[:95]:
+            self.glyph(char)
+
+    def glyph(self, char):
+        mask = self._glyphs.get(char)
+        if mask is None:
+            (width, _), _ = cv2.getTextSize(char, FONT, self.scale, self.thickness)
+            canvas = np.zeros((self.height, max(width, 1)), np.uint8)
+            cv2.putText(canvas, char, (0, self.height - self._baseline), FONT, self.scale, 255, self.thickness,
+                        cv2.LINE_AA)
+            mask = self._glyphs[char] = canvas >= 128
+        return mask
+
+    def text(self, text):
+        """Return the mask of text; recently used strings are kept whole."""
+        mask = self._texts.get(text)
+        if mask is not None:
+            self._texts.move_to_end(text)
+            return mask
+        mask = np.hstack([self.glyph(char) for char in text or " "])
+        self._texts[text] = mask
+        while len(self._texts) > self.max_texts:
+            self._texts.popitem(last=False)
+        return mask
+
+
+class Overlay:
+    """Annotations of the current frame, from motion and inference analysers.
+
+    The pipeline runs it after the other analysers, so analyse() sees their
+    results for the same frame, and calls draw() for overlaid renditions.
+    Annotations are published on events as JSON whenever they change,
+    boxes as normalised (x, y, w, h) of the view.  enabled is true while
+    such a metadata-only client is connected.
+    """
+
+    def __init__(self, motion=None, inference=None, timestamp=True, scale=0.5, line_width=2):
+        self.motion = motion
+        self.inference = inference
+        self.timestamp = timestamp
+        self.line_width = line_width
+        self.glyphs = GlyphCache(scale)
+        self.events = FrameBroadcaster()
+        self.draw_stats = StageStats()
+        self.boxes = []
+        self.lines = []
+        self._published = None
+
+    @property
+    def enabled(self):
+        return self.events.clients > 0
+
+    def analyse(self, frame, sequence):
+        """Collect the annotations for frame from the motion and inference results."""
+        boxes, lines = [], []
+        if self.motion is not None and self.motion.moving:
+            # Scores can still be of the zones before an update, so a zone gone since is skipped
+            zones, scores = self.motion.zones, self.motion.scores
+            boxes += [{"box": list(zones[name]), "label": f"motion: {name}", "kind": "motion"}
+                      for name, score in scores.items() if score >= self.motion.min_area and name in zones]
+        result = self.inference.latest if self.inference is not None else None
+        if result:
+            boxes += [{"box": d["box"], "label": f"{d['label']} {d['score']:.0%}", "kind": "detection"}
+                      for d in result.get("detections", ())]
+            lines += [f"{c['label']} {c['score']:.0%}" for c in result.get("classes", ())]
+        self.boxes, self.lines = boxes, lines
+        if (boxes, lines) != self._published:
+            self._published = (boxes, lines)
+            self.events.publish(json.dumps({"type": "overlay", "sequence": sequence, "timestamp": frame.timestamp,
+                                            "boxes": boxes, "lines": lines}))
+
+    def _label(self, image, text, left, top):
+        """Paint text on a dark background with its top-left corner at (left, top)."""
+        mask = self.glyphs.text(text)
+        height, width = image.shape[:2]
+        left, top = min(max(left, 0), width - 1), min(max(top, 0), height - 1)
+        mask = mask[:height - top, :width - left]
+        region = image[top:top + mask.shape[0], left:left + mask.shape[1]]
+        region[...] = LABEL_BACKGROUND
+        region[mask] = TEXT_COLOUR
+
+    def _box(self, image, box, colour):
+        height, width = image.shape[:2]
+        x, y, w, h = box
+        left, top = int(x * width), int(y * height)
+        right, bottom = min(int((x + w) * width), width), min(int((y + h) * height), height)
+        t = self.line_width
+        image[top:top + t, left:right] = colour
+        image[max(bottom - t, 0):bottom, left:right] = colour
+        image[top:bottom, left:left + t] = colour
+        image[top:bottom, max(right - t, 0):right] = colour
+        return left, top
+
+    def draw(self, image, copy=True):
+        """Return a BGR image with the current annotations drawn on it (on a copy unless copy is False)."""
+        start = time.perf_counter()
+        if copy:
+            image = image.copy()
+        for annotation in self.boxes:
+            colour = MOTION_COLOUR if annotation["kind"] == "motion" else DETECTION_COLOUR
+            left, top = self._box(image, annotation["box"], colour)
+            self._label(image, annotation["label"], left, top - self.glyphs.height)
+        lines = list(self.lines)
+        if self.timestamp:
+            lines.insert(0, time.strftime("%Y-%m-%d %H:%M:%S"))
+        for row, text in enumerate(lines):
+            self._label(image, text, 4, 4 + row * self.glyphs.height)
+        self.draw_stats.record(time.perf_counter() - start)
+        return image
+
+    def as_dict(self):
+        return {"boxes": self.boxes, "lines": self.lines, "glyphs": len(self.glyphs._glyphs),
+                "draw": self.draw_stats.as_dict()}
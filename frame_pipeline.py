@@ -0,0 +1,288 @@
+"""Capture -> encode -> publish loop shared by the streaming servers."""
+import logging
+import threading
+import time
+
+import cv2
+
+from frame_source import Frame
+from frame_stats import StageStats
+from jpeg_encoders import create_encoder
+
+# Names clients may use for the rendition widths in ?size=
+RENDITION_NAMES = {"thumb": 320, "sd": 640, "hd": 1280}
+
+
+class FramePipeline:
+    """Read frames from a source, encode each one once and publish it.
+
+    process, if given, transforms every captured frame before it is encoded
+    (the ROI server crops with it).  encoder is a jpeg_encoders backend;
+    frames it can take in their camera layout skip colour conversion
+    entirely.  There is no fixed sleep: the loop is paced by the source, so
+    it runs at the sensor's frame rate.  Per-stage timings and the
+    producer's CPU time are kept so the servers and benchmark.py can report
+    them.
+
+    renditions lists extra, smaller widths to offer next to the full-size
+    stream on broadcaster.  A rendition is encoded only while it has at
+    least one client; it is taken straight from a camera stream of that
+    width (such as the ISP-scaled lores stream) when there is one, and
+    otherwise downscaled from the smallest larger stream.
+
+    Crop channels (see set_channel()) stream a normalised (x, y, w, h)
+    region of the full-size stream on a broadcaster of their own, cut out at
+    the stream's native resolution; like renditions they are encoded only
+    while watched.
+
+    analysers (such as frame_motion.MotionDetector) see every captured frame
+    before it is encoded, through analyse(frame, sequence), where sequence
+    counts the pipeline's frames.  While any of them is enabled the pipeline
+    keeps capturing even with no viewers.
+
+    gate (a frame_motion.ChangeGate) skips encoding and publishing frames
+    that look the same as the last one sent; a broadcaster that gained a
+    client since the previous frame is sent one anyway.  report() estimates
+    the encode time and bytes this saved.
+
+    overlay (a frame_overlay.Overlay) runs after the analysers and adds an
+    overlaid twin of every rendition, chosen with rendition(size,
+    overlay=True); each one watched is drawn on and encoded once per frame,
+    however many clients share it.
+    """
+
+    STAGES = ("capture", "analyse", "process", "encode", "publish")
+
+    def __init__(self, source, broadcaster, process=None, encoder=None, renditions=(), analysers=(), gate=None,
+                 overlay=None):
+        self.source = source
+        self.broadcaster = broadcaster
+        self.process = process
+        self.encoder = encoder or create_encoder()
+        self.analysers = list(analysers) + ([overlay] if overlay is not None else [])
+        self.gate = gate
+        self.overlay = overlay
+        # id(broadcaster) -> (clients at the last frame, size of the last frame sent to it)
+        self._sent = {}
+        self.broadcasters = {source.size[0]: broadcaster}
+        for width in renditions:
+            self.broadcasters.setdefault(width, broadcaster.sibling())
+        self.overlay_broadcasters = {width: broadcaster.sibling() for width in self.broadcasters} if overlay else {}
+        # name -> (broadcaster, rect); replaced wholesale so the producer thread never sees a partial update
+        self.channels = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {stage: StageStats() for stage in self.STAGES}
+        self.rendition_stats = {width: StageStats() for width in self.broadcasters}
+        self.overlay_stats = {width: StageStats() for width in self.overlay_broadcasters}
+        self.channel_stats = {}
+        self.skipped_encodes = 0
+        self.encode_time_saved = 0.0
+        self.bytes_saved = 0
+        self.frames = 0
+        self.cpu_time = 0.0
+        self.started_at = time.perf_counter()
+
+    def rendition(self, size=None, overlay=False):
+        """Return the broadcaster for a ?size= value: a width or a RENDITION_NAMES key.
+
+        The nearest offered width wins; no size means the full-size stream.
+        With overlay, the overlaid twin is returned when there is an overlay.
+        """
+        broadcasters = self.overlay_broadcasters if overlay and self.overlay else self.broadcasters
+        if not size:
+            return broadcasters[self.source.size[0]]
+        width = RENDITION_NAMES.get(size) or int(size)
+        return broadcasters[min(broadcasters, key=lambda offered: abs(offered - width))]
+
+    def rendition_width(self, broadcaster):
+        """Return the width a rendition broadcaster carries, 0 for a crop channel's."""
+        for broadcasters in (self.broadcasters, self.overlay_broadcasters):
+            for width, candidate in broadcasters.items():
+                if candidate is broadcaster:
+                    return width
+        return 0
+
+    def set_channel(self, name, rect):
+        """Stream the normalised region rect on channel name, creating it if needed.
+
+        Clients already on the channel keep their connection when its rect
+        changes; rect None pauses the channel until it is set again.
+        """
+        broadcaster = self.channels[name][0] if name in self.channels else self.broadcaster.sibling()
+        self.channels = dict(self.channels, **{name: (broadcaster, rect)})
+        return broadcaster
+
+    def remove_channel(self, name):
+        """Delete channel name and close its broadcaster, ending its clients; KeyError if there is none."""
+        broadcaster = self.channels[name][0]
+        self.channels = {other: channel for other, channel in self.channels.items() if other != name}
+        self.channel_stats.pop(name, None)
+        self._sent.pop(id(broadcaster), None)
+        broadcaster.close()
+
+    def channel(self, name):
+        """Return the broadcaster of a crop channel; KeyError if it was never set."""
+        return self.channels[name][0]
+
+    def _crop(self, frame, rect, scaled):
+        """Return (array, fmt, width) for the rect region of the full-size stream."""
+        if "full" not in scaled:
+            scaled["full"] = frame.bgr()
+        image = scaled["full"]
+        height, width = image.shape[:2]
+        x, y, w, h = rect
+        left, top = int(x * width), int(y * height)
+        image = image[top:top + max(int(h * height), 1), left:left + max(int(w * width), 1)]
+        return image, "BGR", image.shape[1]
+
+    def _prepare(self, frame, width, scaled):
+        """Return (array, fmt, width) to encode for one rendition of frame.
+
+        BGR images built along the way are kept in scaled so renditions
+        sharing a camera stream convert and process it only once.
+        """
+        streams = [frame] + ([frame.lores] if frame.lores is not None else [])
+        for stream in streams:
+            if stream.width == width and self.process is None and stream.fmt in self.encoder.formats:
+                return stream.array, stream.fmt, stream.width
+        # Smallest stream at least as wide as the rendition, else the largest
+        larger = [stream for stream in streams if stream.width >= width]
+        stream = min(larger, key=lambda s: s.width) if larger else max(streams, key=lambda s: s.width)
+        if id(stream) not in scaled:
+            image = stream.bgr()
+            if self.process is not None:
+                image = self.process(image)
+            scaled[id(stream)] = image
+        image = scaled[id(stream)]
+        # The full-size stream is sent as processed; smaller renditions are scaled to their width
+        if width != self.source.size[0] and image.shape[1] != width:
+            height = round(image.shape[0] * width / image.shape[1] / 2) * 2
+            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        return image, "BGR", image.shape[1]
+
+    def _unchanged(self, broadcaster, stats, gated):
+        """Return True, counting what it saved, if a gated frame need not be sent to broadcaster."""
+        clients, size = self._sent.get(id(broadcaster), (0, 0))
+        if not gated or broadcaster.clients > clients:
+            return False
+        self._sent[id(broadcaster)] = (broadcaster.clients, size)
+        self.skipped_encodes += 1
+        self.encode_time_saved += stats.total / stats.count if stats.count else 0.0
+        self.bytes_saved += size * broadcaster.clients
+        return True
+
+    def _encode(self, broadcaster, array, fmt, width):
+        data = self.encoder.encode(array, fmt, width)
+        self._sent[id(broadcaster)] = (broadcaster.clients, len(data))
+        return broadcaster, data
+
+    def step(self):
+        """Capture one frame, then encode and publish every watched rendition."""
+        cpu_start = time.thread_time()
+        t0 = time.perf_counter()
+        encoded = []
+        prepare_time = encode_time = 0.0
+        # Encode while the frame is acquired so camera buffers are read in place
+        with self.source.acquire() as frame:
+            t1 = time.perf_counter()
+            timestamp = frame.timestamp
+            for analyser in self.analysers:
+                analyser.analyse(frame, self.frames + 1)
+            analyse_time = time.perf_counter() - t1
+            gated = self.gate is not None and not self.gate.changed(frame)
+            scaled = {}
+            targets = [(width, broadcaster, self.rendition_stats[width], False)
+                       for width, broadcaster in self.broadcasters.items()]
+            targets += [(width, broadcaster, self.overlay_stats[width], True)
+                        for width, broadcaster in self.overlay_broadcasters.items()]
+            for width, broadcaster, stats, overlaid in targets:
+                if not broadcaster.clients or self._unchanged(broadcaster, stats, gated):
+                    continue
+                start = time.perf_counter()
+                array, fmt, array_width = self._prepare(frame, width, scaled)
+                if overlaid:
+                    # Draw on a copy unless the conversion to BGR already made one
+                    image = array if fmt == "BGR" else Frame(array, fmt, width=array_width).bgr()
+                    array, fmt = self.overlay.draw(image, copy=image is array), "BGR"
+                    array_width = array.shape[1]
+                prepared = time.perf_counter()
+                encoded.append(self._encode(broadcaster, array, fmt, array_width))
+                done = time.perf_counter()
+                prepare_time += prepared - start
+                encode_time += done - prepared
+                stats.record(done - start)
+            for name, (broadcaster, rect) in self.channels.items():
+                if rect is None or not broadcaster.clients:
+                    continue
+                if self._unchanged(broadcaster, self.channel_stats.get(name, StageStats()), gated):
+                    continue
+                start = time.perf_counter()
+                array, fmt, array_width = self._crop(frame, rect, scaled)
+                prepared = time.perf_counter()
+                encoded.append(self._encode(broadcaster, array, fmt, array_width))
+                done = time.perf_counter()
+                prepare_time += prepared - start
+                encode_time += done - prepared
+                self.channel_stats.setdefault(name, StageStats()).record(done - start)
+        t2 = time.perf_counter()
+        for broadcaster, data in encoded:
+            broadcaster.publish(data, self.frames + 1, timestamp)
+        t3 = time.perf_counter()
+
+        self.stats["capture"].record(t1 - t0)
+        self.stats["analyse"].record(analyse_time)
+        self.stats["process"].record(prepare_time)
+        self.stats["encode"].record(encode_time)
+        self.stats["publish"].record(t3 - t2)
+        self.cpu_time += time.thread_time() - cpu_start
+        self.frames += 1
+
+    def run(self):
+        """Produce frames until stop() is called, idling while nobody watches and no analyser runs."""
+        while not self._stop.is_set():
+            watching = any(analyser.enabled for analyser in self.analysers)
+            if not watching and not self.broadcaster.wait_for_clients(timeout=1.0):
+                continue
+            try:
+                self.step()
+            except Exception as e:
+                logging.error(f"Error producing video frame: {e}")
+                time.sleep(0.1)
+
+    def start(self):
+        """Run the pipeline on a daemon thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            self._thread = None
+
+    def report(self):
+        """Return throughput, per-stage latency and CPU per frame so far."""
+        elapsed = time.perf_counter() - self.started_at
+        return {
+            "frames": self.frames,
+            "fps": self.frames / elapsed if elapsed > 0 else 0.0,
+            "cpu_ms_per_frame": self.cpu_time / self.frames * 1000 if self.frames else 0.0,
+            "encoder": repr(self.encoder),
+            "buffers_in_flight": self.source.in_flight,
+            "buffer_leaks": self.source.leaks(),
+            "stages": {name: stats.as_dict() for name, stats in self.stats.items()},
+            "renditions": {width: dict(stats.as_dict(), clients=self.broadcasters[width].clients)
+                           for width, stats in self.rendition_stats.items()},
+            "overlays": {width: dict(stats.as_dict(), clients=self.overlay_broadcasters[width].clients)
+                         for width, stats in self.overlay_stats.items()},
+            "channels": {name: dict(self.channel_stats.get(name, StageStats()).as_dict(), rect=rect,
+                                    clients=broadcaster.clients)
+                         for name, (broadcaster, rect) in self.channels.items()},
+            "gate": self.gate and dict(self.gate.as_dict(), skipped_encodes=self.skipped_encodes,
+                                       encode_ms_saved=self.encode_time_saved * 1000, bytes_saved=self.bytes_saved),
+        }
@@ -0,0 +1,115 @@
+"""Binary websocket messages: a fixed 24-byte header followed by the raw payload.
+
+Sending JPEGs as base64 text costs a base64 pass on the Pi, a third more
+bytes on the wire and a decode in the browser.  Every message here is one
+binary websocket frame instead:
+
+    offset  size  field
+    0       2     magic b"PC"
+    2       1     version (1)
+    3       1     kind: JPEG, MOTION, INFERENCE or OVERLAY
+    4       2     rendition width in pixels, 0 for metadata
+    6       2     reserved, 0
+    8       4     frame sequence number of the pipeline, 0 if unknown
+    12      8     sensor timestamp in nanoseconds, 0 if unknown
+    20      4     payload length in bytes
+
+all little-endian.  JPEG payloads are the encoded image as it is, ready
+for new Blob([payload]); metadata payloads are the UTF-8 JSON the motion,
+inference and overlay analysers publish, their sequence numbers and
+timestamps copied into the header so a client can match them to frames
+without parsing them first.  multiplex() sends video and metadata over
+one socket.
+"""
+import asyncio
+import json
+import struct
+from contextlib import ExitStack
+
+MAGIC = b"PC"
+VERSION = 1
+HEADER = struct.Struct("<2sBBHxxIQI")
+
+JPEG = 1
+MOTION = 2
+INFERENCE = 3
+OVERLAY = 4
+KINDS = {"jpeg": JPEG, "motion": MOTION, "inference": INFERENCE, "overlay": OVERLAY}
+
+
+def pack(kind, payload, sequence=0, timestamp=0, rendition=0):
+    """Return one message: the header for payload (bytes or str) followed by it."""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    header = HEADER.pack(MAGIC, VERSION, kind, rendition, (sequence or 0) & 0xFFFFFFFF, timestamp or 0,
+                         len(payload))
+    return header + payload
+
+
+def pack_event(kind, event):
+    """Pack an analyser's JSON event, copying its sequence and timestamp into the header."""
+    fields = json.loads(event)
+    return pack(kind, event, fields.get("sequence", 0), fields.get("timestamp", 0))
+
+
+def unpack(message):
+    """Return (kind, rendition, sequence, timestamp, payload) of a message; ValueError if it is not one."""
+    if len(message) < HEADER.size:
+        raise ValueError("Message shorter than the header.")
+    magic, version, kind, rendition, sequence, timestamp, length = HEADER.unpack_from(message)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a version {VERSION} frame message.")
+    if len(message) != HEADER.size + length:
+        raise ValueError("Payload length does not match the header.")
+    return kind, rendition, sequence, timestamp, memoryview(message)[HEADER.size:]
+
+
+class MessageCache:
+    """The packed form of the latest item of each broadcaster, built once for all its clients.
+
+    Only used from coroutines on one event loop, so it needs no lock.
+    """
+
+    def __init__(self):
+        self._messages = {}
+        self.packed = 0
+        self.hits = 0
+
+    def message(self, kind, broadcaster, sequence, payload, rendition=0):
+        cached = self._messages.get(id(broadcaster))
+        if cached is not None and cached[0] == sequence:
+            self.hits += 1
+            return cached[1]
+        if kind == JPEG:
+            number, timestamp = broadcaster.frame_info(sequence)
+            message = pack(JPEG, payload, number, timestamp, rendition)
+        else:
+            message = pack_event(kind, payload)
+        self._messages[id(broadcaster)] = (sequence, message)
+        self.packed += 1
+        return message
+
+
+async def multiplex(send, streams, cache):
+    """Send every stream's items as messages through send(message) until cancelled.
+
+    streams is a list of (kind, broadcaster, rendition, maxsize).  Each
+    gets a client of its own, so a burst of video never pushes metadata
+    out of its queue, and whichever has an item is sent first.
+    """
+    with ExitStack() as stack:
+        clients = [(kind, broadcaster, rendition, stack.enter_context(broadcaster.client(maxsize)))
+                   for kind, broadcaster, rendition, maxsize in streams]
+        pending = {asyncio.ensure_future(stream[3].get()): stream for stream in clients}
+        try:
+            while True:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    kind, broadcaster, rendition, client = stream = pending.pop(task)
+                    sequence, payload = task.result()
+                    await send(cache.message(kind, broadcaster, sequence, payload, rendition))
+                    client.sent += 1
+                    pending[asyncio.ensure_future(client.get())] = stream
+        finally:
+            for task in pending:
+                task.cancel()
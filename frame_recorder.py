@@ -0,0 +1,150 @@
+"""Continuous H.264 recording in fixed-length segments with a rolling disk budget.
+
+Where the Pi has an H.264 encoder block (the Pi 4 and earlier),
+Picamera2's H264Encoder records with it (see frame_h264) and the CPU does
+not encode at all.  The Pi 5 and boxes without the camera have none:
+frames from the pipeline are encoded with libx264 through PyAV instead,
+which takes real CPU time; status() reports it as encode_cpu_ms_per_frame.
+
+Either way the keyframe interval equals the segment length, so a new
+segment starts on every keyframe once segment_seconds have passed.
+Segments are MPEG-TS files, playable on their own and still readable if
+the Pi loses power mid-segment; they are written under a hidden name and
+renamed into place when complete.  index.json lists the finished segments
+with their start times, and the oldest are deleted whenever the total goes
+over budget_bytes.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from frame_h264 import H264Feed, mux, open_container
+
+
+class SegmentedRecorder(H264Feed):
+    """Record H.264 into directory as segment_seconds long .ts segments.
+
+    Call start(source) to begin; see H264Feed for how source is encoded.
+    """
+
+    def __init__(self, directory, segment_seconds=10, budget_bytes=4 * 1024 ** 3, fps=30, bitrate=4000000,
+                 stream="main", software=False):
+        super().__init__(segment_seconds, fps, bitrate, stream, software)
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.budget_bytes = budget_bytes
+        self.bytes_written = 0
+        self.deleted = 0
+        self._segment = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, "index.json")
+        self.index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return []
+        # Segments deleted by hand since the last run are forgotten
+        return [segment for segment in index if os.path.exists(os.path.join(self.directory, segment["name"]))]
+
+    def _save_index(self):
+        temp = f"{self._index_path}.tmp"
+        with open(temp, "w") as f:
+            json.dump(self.index, f)
+        os.replace(temp, self._index_path)
+
+    @property
+    def recording(self):
+        return self.running
+
+    def start(self, source, size=None):
+        """Start recording from source; size is the software encoder's frame size (default the frame's)."""
+        if self.running:
+            return
+        self.start_encoder(source, size)
+        logging.info(f"Recording started ({self.mode} H.264, {self.segment_seconds} s segments)")
+
+    def stop(self):
+        """Stop recording and close the segment being written."""
+        if not self.running:
+            return
+        self.stop_encoder()
+        with self._lock:
+            self._close_segment()
+        logging.info("Recording stopped")
+
+    def write(self, data, keyframe, timestamp):
+        """Add one encoded access unit (timestamp in microseconds), starting a new segment on a due keyframe."""
+        with self._lock:
+            segment = self._segment
+            if keyframe and (segment is None or self.keyframe_due(segment["first"], timestamp)):
+                self._close_segment()
+                segment = self._open_segment(timestamp)
+            if segment is None:
+                return  # Wait for the first keyframe
+            mux(segment["container"], segment["stream"], data, keyframe, timestamp)
+            segment["bytes"] += len(data)
+            segment["last"] = timestamp
+            self.bytes_written += len(data)
+
+    def _open_segment(self, timestamp):
+        started = time.time()
+        name = f"segment_{datetime.fromtimestamp(started).strftime('%Y%m%d_%H%M%S_%f')[:-3]}.ts"
+        temp = os.path.join(self.directory, f".{name}.tmp")
+        container, stream = open_container(temp, self.size, self.fps)
+        self._segment = {"name": name, "temp": temp, "container": container, "stream": stream,
+                         "started": started, "first": timestamp, "last": timestamp, "bytes": 0}
+        return self._segment
+
+    def _close_segment(self):
+        segment, self._segment = self._segment, None
+        if segment is None:
+            return
+        try:
+            segment["container"].close()
+            os.replace(segment["temp"], os.path.join(self.directory, segment["name"]))
+        except Exception as e:
+            self.last_error = str(e)
+            logging.error(f"Failed to finish segment {segment['name']}: {e}")
+            return
+        duration = (segment["last"] - segment["first"]) / 1000000 + 1 / self.fps
+        self.index.append({"name": segment["name"], "start": segment["started"],
+                           "duration": round(duration, 3), "bytes": os.path.getsize(
+                               os.path.join(self.directory, segment["name"]))})
+        self._enforce_budget()
+        self._save_index()
+
+    def _enforce_budget(self):
+        """Delete the oldest segments until the total fits in budget_bytes."""
+        total = sum(segment["bytes"] for segment in self.index)
+        while self.index and total > self.budget_bytes:
+            oldest = self.index.pop(0)
+            total -= oldest["bytes"]
+            try:
+                os.unlink(os.path.join(self.directory, oldest["name"]))
+            except FileNotFoundError:
+                pass
+            self.deleted += 1
+
+    def segments(self, since=None, until=None):
+        """Return the finished segments overlapping [since, until), as Unix times."""
+        since = since if since is not None else float("-inf")
+        until = until if until is not None else float("inf")
+        with self._lock:
+            return [dict(segment) for segment in self.index
+                    if segment["start"] + segment["duration"] > since and segment["start"] < until]
+
+    def status(self):
+        with self._lock:
+            current = self._segment and {"name": self._segment["name"], "bytes": self._segment["bytes"]}
+            total = sum(segment["bytes"] for segment in self.index)
+            count = len(self.index)
+        return {"recording": self.recording, "segments": count, "bytes_on_disk": total,
+                "budget_bytes": self.budget_bytes, "current": current, "bytes_written": self.bytes_written,
+                "deleted": self.deleted, **self.encoder_status()}
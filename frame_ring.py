@@ -0,0 +1,176 @@
+"""Pre-event buffer: the last few seconds of encoded video, saved as a clip on demand.
+
+FrameRing subscribes to one rendition's broadcaster and copies each JPEG
+the pipeline has already encoded into a single bytearray allocated up
+front, overwriting the oldest frames once it is full.  Memory is therefore
+fixed by capacity in bytes however large the frames get, and keeping the
+buffer costs one memcpy per frame.
+
+save_clip() writes the frames of the last before seconds and those that
+arrive in the after seconds that follow into a Matroska file, muxing the
+JPEGs as MJPEG packets with PyAV: nothing is decoded or re-encoded, and
+the producer only ever waits for the copy of a single frame.
+"""
+import io
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from fractions import Fraction
+
+from PIL import Image
+
+from frame_stats import StageStats
+
+
+class FrameRing:
+    """Circular store of the most recent encoded frames, capacity bytes in total.
+
+    Frames are kept whole and contiguous: one that does not fit before the
+    end of the buffer wraps to the start, evicting the oldest frames it
+    overlaps.
+    """
+
+    def __init__(self, capacity=32 * 1024 * 1024):
+        self.capacity = capacity
+        self._storage = bytearray(capacity)
+        self._view = memoryview(self._storage)
+        # (id, offset, size, monotonic time) per stored frame, oldest first
+        self._index = deque()
+        self._ids = itertools.count(1)
+        self._head = 0
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stored = 0
+        self.dropped = 0
+        self.clips = 0
+        self.clip_stats = StageStats()
+
+    def append(self, data, timestamp=None):
+        """Copy one encoded frame into the buffer."""
+        size = len(data)
+        if size > self.capacity:
+            self.dropped += 1
+            return
+        with self._condition:
+            position = self._head
+            if position + size > self.capacity:
+                # Drop the older frames left between the head and the end, and wrap
+                while self._index and self._index[0][1] >= position:
+                    self._index.popleft()
+                position = 0
+            end = position + size
+            while self._index and self._index[0][1] < end and self._index[0][1] + self._index[0][2] > position:
+                self._index.popleft()
+            self._view[position:end] = data
+            self._index.append((next(self._ids), position, size, timestamp or time.monotonic()))
+            self._head = end
+            self.stored += 1
+            self._condition.notify_all()
+
+    def _after(self, last_id, since):
+        """Return the index entries newer than last_id and taken at or after since."""
+        with self._condition:
+            return [entry for entry in self._index if entry[0] > last_id and entry[3] >= since]
+
+    def _read(self, entry):
+        """Return a copy of a stored frame, or None if it has been overwritten since."""
+        with self._condition:
+            if not self._index or entry[0] < self._index[0][0]:
+                return None
+            return bytes(self._view[entry[1]:entry[1] + entry[2]])
+
+    def run(self, broadcaster):
+        """Store every frame published on broadcaster until stop() is called."""
+        sequence = 0
+        with broadcaster.subscribe():
+            while not self._stop.is_set():
+                sequence, frame = broadcaster.wait(sequence, timeout=1.0)
+                if frame is not None:
+                    self.append(frame)
+
+    def start(self, broadcaster):
+        """Fill the buffer from broadcaster on a daemon thread.
+
+        The subscription counts as a client, so the pipeline keeps encoding
+        that rendition even when nobody is watching.
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, args=(broadcaster,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            self._thread = None
+
+    def save_clip(self, path, before=10.0, after=5.0):
+        """Write the last before seconds and the next after seconds to an MJPEG .mkv at path.
+
+        Blocks for about after seconds, so run it off the event loop.  The
+        clip is written under a hidden name and renamed into place when
+        complete.  Returns the number of frames written.
+        """
+        import av
+
+        start = time.perf_counter()
+        now = time.monotonic()
+        since, end = now - before, now + after
+        directory, name = os.path.split(path)
+        temp = os.path.join(directory, f".{name}.tmp")
+        container = stream = origin = None
+        frames, last_id = 0, 0
+        try:
+            while True:
+                for entry in self._after(last_id, since):
+                    last_id = entry[0]
+                    data = self._read(entry)
+                    if data is None:
+                        continue  # Overwritten while older frames were being written
+                    if stream is None:
+                        width, height = Image.open(io.BytesIO(data)).size
+                        container = av.open(temp, "w", format="matroska")
+                        stream = container.add_stream("mjpeg", rate=30)
+                        stream.width, stream.height = width, height
+                        stream.pix_fmt = "yuvj420p"
+                        stream.time_base = Fraction(1, 1000)
+                        origin = entry[3]
+                    packet = av.Packet(data)
+                    packet.stream = stream
+                    packet.time_base = stream.time_base
+                    packet.pts = packet.dts = round((entry[3] - origin) * 1000)
+                    container.mux(packet)
+                    frames += 1
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    break
+                with self._condition:
+                    self._condition.wait(min(remaining, 0.5))
+            if container is None:
+                raise RuntimeError("No frames buffered for the clip.")
+            container.close()
+            container = None
+            os.replace(temp, path)
+        finally:
+            if container is not None:
+                container.close()
+            if os.path.exists(temp):
+                os.unlink(temp)
+        self.clips += 1
+        self.clip_stats.record(time.perf_counter() - start)
+        logging.info(f"Clip saved: {path} ({frames} frames, {before:g} s before and {after:g} s after)")
+        return frames
+
+    def status(self):
+        """Return fill level, the seconds of video held and counters."""
+        with self._condition:
+            used = sum(entry[2] for entry in self._index)
+            frames = len(self._index)
+            seconds = self._index[-1][3] - self._index[0][3] if frames else 0.0
+        return {"capacity_bytes": self.capacity, "used_bytes": used, "frames": frames,
+                "seconds": round(seconds, 2), "stored": self.stored, "dropped": self.dropped,
+                "clips": self.clips, "save": self.clip_stats.as_dict()}
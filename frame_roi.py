@@ -0,0 +1,99 @@
+"""Named regions of interest, each streamed on its own pipeline channel.
+
+A region is a normalised (x, y, w, h) rectangle of the full camera view.
+Regions are cut out of the full-size stream in software, except that a
+lone region marked sensor=True is pushed to the camera's ScalerCrop control
+instead: the whole stream then becomes that view, scaled up by the ISP from
+the sensor's native pixels rather than cut out of the downscaled frame.
+ScalerCrop crops every camera stream, so this only happens while nobody
+watches the full view, stills do not share the video mode (dual_stream)
+and the camera is not switched to its still mode; call refresh() when a
+full-view viewer arrives or leaves and after a still capture.  Adding a
+second region also restores the full view and crops both in software.
+"""
+import logging
+import threading
+
+FULL_VIEW = (0.0, 0.0, 1.0, 1.0)
+
+
+def parse_rect(data):
+    """Return a validated (x, y, w, h) tuple from a dict or a 4-item sequence."""
+    if isinstance(data, dict):
+        data = [data.get(key) for key in ("x", "y", "w", "h")]
+    try:
+        x, y, w, h = (float(value) for value in data)
+    except (TypeError, ValueError):
+        raise ValueError("A region needs numeric x, y, w and h.")
+    if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > 1 or y + h > 1:
+        raise ValueError("A region must lie inside the normalised 0..1 frame.")
+    return x, y, w, h
+
+
+class RoiSet:
+    """The regions currently defined on a pipeline and its source."""
+
+    def __init__(self, pipeline, source):
+        self.pipeline = pipeline
+        self.source = source
+        self.regions = {}
+        self.sensor_crop = None
+        self._lock = threading.Lock()
+
+    def set(self, name, rect, sensor=False):
+        """Define or move region name; returns its channel's broadcaster."""
+        with self._lock:
+            self.regions[name] = {"rect": parse_rect(rect), "sensor": bool(sensor)}
+            broadcaster = self.pipeline.set_channel(name, self.regions[name]["rect"])
+            self._apply()
+        return broadcaster
+
+    def remove(self, name):
+        """Delete region name and end its channel's clients; KeyError if it does not exist."""
+        with self._lock:
+            del self.regions[name]
+            self._apply()
+            self.pipeline.remove_channel(name)
+
+    def clear(self):
+        with self._lock:
+            names, self.regions = list(self.regions), {}
+            self._apply()
+            for name in names:
+                self.pipeline.remove_channel(name)
+
+    def refresh(self):
+        """Re-decide between the sensor crop and software crops, as full-view viewers come and go."""
+        with self._lock:
+            self._apply()
+
+    def _full_view_watched(self):
+        """True if anything besides the crop channels needs the uncropped camera view."""
+        if self.source.dual_stream or self.source.still_mode:
+            return True
+        broadcasters = list(self.pipeline.broadcasters.values()) + list(self.pipeline.overlay_broadcasters.values())
+        return any(broadcaster.clients for broadcaster in broadcasters)
+
+    def _apply(self):
+        """Push a lone sensor region to the camera when nothing needs the full view, otherwise crop in software."""
+        lone = next(iter(self.regions.items())) if len(self.regions) == 1 else None
+        crop = lone if lone and lone[1]["sensor"] and not self._full_view_watched() else None
+        if crop is None and self.sensor_crop is None:
+            return
+        if crop is not None and self.source.set_crop(crop[1]["rect"]):
+            # The stream is now the region itself, so its channel sends the whole frame
+            self.sensor_crop = crop[0]
+            self.pipeline.set_channel(crop[0], FULL_VIEW)
+            return
+        if self.sensor_crop is not None:
+            self.source.set_crop(None)
+            if self.sensor_crop in self.regions:
+                self.pipeline.set_channel(self.sensor_crop, self.regions[self.sensor_crop]["rect"])
+            logging.info("Sensor crop released; regions are cropped in software.")
+        self.sensor_crop = None
+
+    def as_dict(self):
+        with self._lock:
+            return {name: {"rect": region["rect"], "sensor": region["sensor"],
+                           "sensor_crop": name == self.sensor_crop}
+                    for name, region in self.regions.items()}
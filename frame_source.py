@@ -0,0 +1,507 @@
+"""Frame sources for the streaming servers.
+
+The servers read frames through one of these classes instead of building
+Picamera2() or cv2.VideoCapture(0) themselves, so the capture pipeline can
+run against the Pi camera, a USB webcam, or a synthetic/replay source on a
+machine with no camera attached.  open_source() picks the backend from the
+CAMERA_SOURCE environment variable.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+import cv2
+import numpy as np
+
+
+class Frame:
+    """One acquired video frame.
+
+    array holds the pixels in the layout named by fmt: "BGR" for plain
+    OpenCV arrays, otherwise the Picamera2 format name ("RGB888" is BGR
+    order, "XBGR8888" is RGBX, "YUV420" keeps the buffer's row stride).
+    width is the image width when the rows carry padding.  lores, when the
+    camera also produced a smaller ISP-scaled image of the same exposure, is
+    another Frame.  Frames from FrameSource.acquire() may be views straight
+    into a camera buffer and are only valid inside the acquire() block.
+    """
+
+    def __init__(self, array, fmt="BGR", metadata=None, timestamp=None, width=None, lores=None):
+        self.array = array
+        self.fmt = fmt
+        self.metadata = metadata or {}
+        self.timestamp = timestamp if timestamp is not None else time.monotonic_ns()
+        self.width = width or array.shape[1]
+        self.lores = lores
+
+    @property
+    def size(self):
+        """(width, height) of the image, whatever the pixel layout."""
+        if self.fmt == "YUV420":
+            return self.width, self.array.shape[0] * 2 // 3
+        return self.width, self.array.shape[0]
+
+    def bgr(self):
+        """Return the image in BGR order for OpenCV to crop and encode.
+
+        BGR-ordered layouts are returned as they are; others are converted.
+        """
+        if self.fmt == "YUV420":
+            return cv2.cvtColor(self.array, cv2.COLOR_YUV2BGR_I420)[:, :self.width]
+        if self.fmt in ("BGR888", "XBGR8888"):
+            return cv2.cvtColor(self.array, cv2.COLOR_RGBA2BGR if self.array.shape[2] == 4 else cv2.COLOR_RGB2BGR)
+        return self.array
+
+
+class FrameSource:
+    """Base class for anything the producer loop reads frames from."""
+
+    def __init__(self, size=(1280, 960), fps=30, still_size=None, dual_stream=False, lores_size=None):
+        self.size = tuple(size)
+        self.fps = fps
+        self.still_size = tuple(still_size) if still_size else None
+        self.dual_stream = dual_stream
+        self.lores_size = tuple(lores_size) if lores_size else None
+        self.still_latency = None
+        self.still_metadata = {}
+        self.burst_fps = None
+        self.model = None
+        # True while the camera is switched to its still mode, which drops any sensor crop
+        self.still_mode = False
+
+    def start(self):
+        """Start delivering frames."""
+
+    def stop(self):
+        """Stop delivering frames and release the device."""
+
+    @property
+    def in_flight(self):
+        """Number of camera buffers currently held by the application."""
+        return 0
+
+    def leaks(self):
+        """Return (thread name, seconds held) for buffers held suspiciously long."""
+        return []
+
+    def read(self):
+        """Return the next video frame as a NumPy array."""
+        raise NotImplementedError
+
+    @contextmanager
+    def acquire(self):
+        """Yield the next video frame as a Frame, valid inside the block."""
+        yield Frame(self.read())
+
+    def set_crop(self, rect=None):
+        """Crop the camera's field of view to a normalised (x, y, w, h).
+
+        None restores the full view.  Returns False when the source cannot
+        crop at the sensor, in which case callers crop in software.
+        """
+        return False
+
+    def capture_still(self):
+        """Return a full-resolution still frame, recording how long it took.
+
+        Sources that report camera metadata leave the still's in
+        still_metadata, for EXIF tags.
+        """
+        start = time.perf_counter()
+        frame = self._capture_still()
+        self.still_latency = time.perf_counter() - start
+        return frame
+
+    def _capture_still(self):
+        return self.read()
+
+    def capture_burst(self, count, on_still):
+        """Capture count full-resolution stills back to back, calling on_still(array, metadata) with each.
+
+        Each still is handed on as soon as it is captured and dropped
+        before the next, so only the ones on_still keeps (queued to a
+        PhotoWriter, say) stay in memory, and a blocking on_still paces the
+        burst.  The camera returns to its video mode even if on_still
+        raises.  Records the burst's frame rate in burst_fps.
+        """
+        start = time.perf_counter()
+        self._capture_burst(count, on_still)
+        self.burst_fps = count / (time.perf_counter() - start)
+
+    def _capture_burst(self, count, on_still):
+        for _ in range(count):
+            array = self._capture_still()
+            on_still(array, self.still_metadata)
+            del array
+
+
+class RequestTracker:
+    """Lifecycle manager for Picamera2 capture requests.
+
+    Every request taken from the camera pins one of its DMA buffers until it
+    is released; holding them all stalls capture.  acquire() caps the number
+    held at once, always releases on exit, and leaks() reports any request
+    held for longer than leak_after seconds.
+    """
+
+    def __init__(self, picam2, max_in_flight=2, leak_after=2.0):
+        self.picam2 = picam2
+        self.max_in_flight = max_in_flight
+        self.leak_after = leak_after
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._held = {}
+
+    @property
+    def in_flight(self):
+        with self._lock:
+            return len(self._held)
+
+    @contextmanager
+    def acquire(self, timeout=5.0):
+        """Yield the next completed request and release it when the block exits."""
+        if not self._slots.acquire(timeout=timeout):
+            raise RuntimeError(f"{self.max_in_flight} camera requests still held, "
+                               f"is one leaking? {self.leaks()}")
+        try:
+            request = self.picam2.capture_request()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._held[id(request)] = (time.monotonic(), threading.current_thread().name)
+        try:
+            yield request
+        finally:
+            request.release()
+            with self._lock:
+                del self._held[id(request)]
+            self._slots.release()
+
+    def leaks(self):
+        """Return (thread name, seconds held) for requests held too long."""
+        now = time.monotonic()
+        with self._lock:
+            held = list(self._held.values())
+        return [(owner, now - since) for since, owner in held if now - since > self.leak_after]
+
+
+class Picamera2Source(FrameSource):
+    """Frames from the Raspberry Pi camera through Picamera2.
+
+    By default video comes from the main stream and every still switches the
+    sensor into a still configuration and back, which stops the stream for
+    the duration.  With dual_stream the camera runs a full-resolution main
+    stream alongside a lores stream at the video size: video is served from
+    lores and a still is simply the main image of the next request, so no
+    mode switch is needed.  The sensor mode is then chosen for the main
+    size, which can lower the achievable video frame rate.  Otherwise
+    lores_size adds a second, ISP-scaled YUV420 video stream that is handed
+    out as Frame.lores for smaller renditions.  Full-colour
+    streams use RGB888, which is BGR order in memory, so OpenCV gets the
+    colours right without a conversion.
+
+    acquire() encodes straight from the camera's mapped buffer: the frame's
+    array is a view into the DMA buffer of a request that is held through a
+    RequestTracker and released as soon as the block exits.
+    """
+
+    def __init__(self, size=(1280, 960), fps=30, still_size=None, dual_stream=False, lores_size=None,
+                 picam2=None):
+        from picamera2 import Picamera2
+
+        super().__init__(size, fps, still_size, dual_stream, lores_size)
+        self.picam2 = picam2 or Picamera2()
+        self.model = self.picam2.camera_properties.get("Model")
+        self.requests = RequestTracker(self.picam2)
+        # Held by acquire() and across every still mode switch, so video frames never see the still mode
+        self._mode_lock = threading.Lock()
+        # The ScalerCrop set by set_crop(), applied again each time the video mode comes back
+        self._crop = None
+        if self.dual_stream:
+            # Few buffers, as each main buffer is a full 12MP image
+            main = {"size": self.still_size or self.picam2.sensor_resolution, "format": "RGB888"}
+            self.video_config = self.picam2.create_video_configuration(
+                main=main, lores={"size": self.size, "format": "YUV420"},
+                buffer_count=4, controls={"FrameRate": fps})
+            self.still_config = None
+        else:
+            lores = {"size": self.lores_size, "format": "YUV420"} if self.lores_size else None
+            self.video_config = self.picam2.create_video_configuration(
+                main={"size": self.size, "format": "RGB888"}, lores=lores, controls={"FrameRate": fps})
+            still_main = {"format": "RGB888"}
+            if self.still_size:
+                still_main["size"] = self.still_size
+            self.still_config = self.picam2.create_still_configuration(main=still_main)
+
+    def start(self):
+        self.picam2.configure(self.video_config)
+        self.picam2.start()
+        self._restore_crop()
+
+    def stop(self):
+        self.picam2.stop()
+
+    def _restore_crop(self):
+        """Re-apply the sensor crop, which configuring the camera for another mode resets."""
+        if self._crop is not None:
+            self.picam2.set_controls({"ScalerCrop": self._crop})
+
+    def read(self):
+        if self.dual_stream:
+            return Frame(self.picam2.capture_array("lores"), "YUV420", width=self.size[0]).bgr()
+        return self.picam2.capture_array("main")
+
+    def set_crop(self, rect=None):
+        """Apply rect through the ScalerCrop control, widened to the stream's aspect ratio.
+
+        The ISP scales the cropped area up to the stream size, so a zoomed
+        view keeps the sensor's native detail.  The new crop lands a few
+        frames after the call, and in dual-stream mode it crops stills too.
+        The crop is kept and re-applied whenever the camera comes back from
+        its still mode; set during a still capture it waits for that.
+        """
+        x0, y0, width, height = self.picam2.camera_properties["ScalerCropMaximum"]
+        if rect is None:
+            crop = (x0, y0, width, height)
+            self._crop = None
+        else:
+            x, y, w, h = rect
+            aspect = self.size[0] / self.size[1]
+            crop_w, crop_h = w * width, h * height
+            # Grow the short side rather than let the ISP stretch the image
+            if crop_w / crop_h < aspect:
+                crop_w = min(crop_h * aspect, width)
+                crop_h = crop_w / aspect
+            else:
+                crop_h = min(crop_w / aspect, height)
+                crop_w = crop_h * aspect
+            centre_x, centre_y = x0 + (x + w / 2) * width, y0 + (y + h / 2) * height
+            left = min(max(centre_x - crop_w / 2, x0), x0 + width - crop_w)
+            top = min(max(centre_y - crop_h / 2, y0), y0 + height - crop_h)
+            crop = (int(left), int(top), int(crop_w), int(crop_h))
+            self._crop = crop
+        if not self.still_mode:
+            self.picam2.set_controls({"ScalerCrop": crop})
+        logging.info(f"Sensor crop set to {crop}")
+        return True
+
+    @property
+    def in_flight(self):
+        return self.requests.in_flight
+
+    def leaks(self):
+        return self.requests.leaks()
+
+    @contextmanager
+    def acquire(self):
+        from picamera2 import MappedArray
+
+        stream = "lores" if self.dual_stream else "main"
+        config = self.video_config[stream]
+        with self._mode_lock, self.requests.acquire() as request, ExitStack() as mappings:
+            metadata = request.get_metadata()
+            timestamp = metadata.get("SensorTimestamp")
+            mapped = mappings.enter_context(MappedArray(request, stream))
+            lores = None
+            if self.lores_size and not self.dual_stream:
+                mapped_lores = mappings.enter_context(MappedArray(request, "lores"))
+                lores = Frame(mapped_lores.array, "YUV420", metadata, timestamp, self.lores_size[0])
+            yield Frame(mapped.array, config["format"], metadata, timestamp, config["size"][0], lores)
+
+    def _capture_still(self):
+        if not self.dual_stream:
+            with self._mode_lock:
+                self.still_mode = True
+                try:
+                    request = self.picam2.switch_mode_and_capture_request(self.still_config)
+                    try:
+                        self.still_metadata = request.get_metadata()
+                        return request.make_array("main")
+                    finally:
+                        request.release()
+                finally:
+                    self.still_mode = False
+                    self._restore_crop()
+        # The still outlives the request, so this one is copied out
+        with self.requests.acquire() as request:
+            self.still_metadata = request.get_metadata()
+            return request.make_array("main")
+
+    def _capture_burst(self, count, on_still):
+        if self.dual_stream:
+            # Full-resolution frames are already streaming; take the next count of them
+            return super()._capture_burst(count, on_still)
+        # One mode switch for the whole burst instead of one per still
+        with self._mode_lock:
+            self.still_mode = True
+            self.picam2.switch_mode(self.still_config)
+            try:
+                for _ in range(count):
+                    request = self.picam2.capture_request()
+                    try:
+                        self.still_metadata = request.get_metadata()
+                        array = request.make_array("main")
+                    finally:
+                        request.release()
+                    on_still(array, self.still_metadata)
+                    del array
+            finally:
+                self.picam2.switch_mode(self.video_config)
+                self.still_mode = False
+                self._restore_crop()
+
+
+class OpenCVSource(FrameSource):
+    """Frames from a V4L2/USB camera through cv2.VideoCapture."""
+
+    def __init__(self, size=(1280, 960), fps=30, still_size=None, dual_stream=False, lores_size=None, device=0):
+        super().__init__(size, fps, still_size, dual_stream, lores_size)
+        self.device = device
+        self.capture = None
+
+    def start(self):
+        self.capture = cv2.VideoCapture(self.device)
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.size[0])
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.size[1])
+        self.capture.set(cv2.CAP_PROP_FPS, self.fps)
+
+    def stop(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+    def read(self):
+        success, frame = self.capture.read()
+        if not success:
+            raise RuntimeError("Failed to read frame from the camera.")
+        return frame
+
+
+class SyntheticSource(FrameSource):
+    """Deterministic frames for machines without a camera.
+
+    With no path a scrolling, noise-textured test pattern is generated; with a
+    path the video or image file is replayed, looping at the end.  Frames are
+    delivered at the target fps (0 means as fast as possible) and at the
+    configured size, so pipeline runs are repeatable on a build box.
+    """
+
+    def __init__(self, size=(1280, 960), fps=30, still_size=None, dual_stream=False, lores_size=None,
+                 path=None, speed=4, seed=0, loop=True):
+        super().__init__(size, fps, still_size, dual_stream, lores_size)
+        self.path = path
+        self.speed = speed
+        self.seed = seed
+        self.loop = loop
+        self.index = 0
+        self._pattern = None
+        self._replay = None
+        self._deadline = None
+
+    def start(self):
+        self.index = 0
+        self._deadline = None
+        if self.path:
+            self._replay = cv2.VideoCapture(self.path)
+            if not self._replay.isOpened():
+                raise RuntimeError(f"Cannot open replay file: {self.path}")
+        else:
+            self._pattern = self._make_pattern()
+
+    def stop(self):
+        if self._replay is not None:
+            self._replay.release()
+            self._replay = None
+
+    def _make_pattern(self):
+        """Build a pattern one period wider than the frame to scroll across."""
+        width, height = self.size
+        period = 256
+        rng = np.random.default_rng(self.seed)
+        xs = np.arange(width + period, dtype=np.uint32)
+        ys = np.arange(height, dtype=np.uint32)
+        pattern = np.empty((height, width + period, 3), dtype=np.uint8)
+        pattern[..., 0] = (xs % period).astype(np.uint8)
+        pattern[..., 1] = (ys * 255 // max(height - 1, 1)).astype(np.uint8)[:, None]
+        pattern[..., 2] = (((xs[None, :] // 32) + (ys[:, None] // 32)) % 2 * 160).astype(np.uint8)
+        pattern += rng.integers(0, 32, pattern.shape, dtype=np.uint8)
+        return pattern
+
+    def _pace(self):
+        """Sleep until the next frame is due at the target frame rate."""
+        if not self.fps:
+            return
+        interval = 1.0 / self.fps
+        now = time.monotonic()
+        if self._deadline is None or now - self._deadline > interval:
+            # First frame, or we fell behind: don't try to catch up in a burst
+            self._deadline = now
+        elif self._deadline > now:
+            time.sleep(self._deadline - now)
+        self._deadline += interval
+
+    def _read_replay(self):
+        success, frame = self._replay.read()
+        if not success and self.loop:
+            self._replay.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            success, frame = self._replay.read()
+        if not success:
+            raise EOFError(f"Replay file exhausted: {self.path}")
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        return frame
+
+    def _next_frame(self):
+        self._pace()
+        if self._replay is not None:
+            frame = self._read_replay()
+        else:
+            # A view into the pattern, like a mapped camera buffer
+            width = self.size[0]
+            offset = (self.index * self.speed) % (self._pattern.shape[1] - width)
+            frame = self._pattern[:, offset:offset + width]
+        self.index += 1
+        return frame
+
+    def read(self):
+        return np.ascontiguousarray(self._next_frame())
+
+    @contextmanager
+    def acquire(self):
+        yield Frame(self._next_frame())
+
+    def _capture_still(self):
+        frame = self.read()
+        if self.still_size and self.still_size != self.size:
+            frame = cv2.resize(frame, self.still_size, interpolation=cv2.INTER_LINEAR)
+        return frame
+
+
+SOURCES = {
+    "picamera2": Picamera2Source,
+    "opencv": OpenCVSource,
+    "synthetic": SyntheticSource,
+}
+
+
+def open_source(kind=None, **kwargs):
+    """Create the frame source named by kind or the CAMERA_SOURCE variable.
+
+    CAMERA_REPLAY gives the file a synthetic source replays, CAMERA_DEVICE
+    the index or path an OpenCV source opens, and CAMERA_DUAL_STREAM=1 turns
+    on the Picamera2 main + lores mode.
+    """
+    kind = kind or os.environ.get("CAMERA_SOURCE", "picamera2")
+    if kind not in SOURCES:
+        raise ValueError(f"Unknown camera source: {kind}")
+    kwargs.setdefault("dual_stream", os.environ.get("CAMERA_DUAL_STREAM") == "1")
+    if kind == "synthetic" and os.environ.get("CAMERA_REPLAY"):
+        kwargs.setdefault("path", os.environ["CAMERA_REPLAY"])
+    if kind == "opencv" and os.environ.get("CAMERA_DEVICE"):
+        device = os.environ["CAMERA_DEVICE"]
+        kwargs.setdefault("device", int(device) if device.isdigit() else device)
+    logging.info(f"Opening {kind} camera source.")
+    return SOURCES[kind](**kwargs)
@@ -0,0 +1,19 @@
+"""Running timings shared by the frame and photo modules, with no heavy imports."""
+
+
+class StageStats:
+    """Running wall-clock timings for one pipeline stage."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        mean = self.total / self.count if self.count else 0.0
+        return {"frames": self.count, "mean_ms": mean * 1000, "max_ms": self.max * 1000}
@@ -1,5 +1,5 @@
 apt update
-apt install -y build-essential cmake git pkg-config libjpeg-dev libtiff-dev lib>
+apt install -y build-essential cmake git pkg-config libjpeg-dev libtiff-dev
 apt install -y libavcodec-dev libavformat-dev libswscale-dev libv4l-dev
 apt install -y libxvidcore-dev libx264-dev libfontconfig1-dev libcairo2-dev
 apt install -y libgdk-pixbuf2.0-dev libpango1.0-dev libgtk2.0-dev libgtk-3-dev
@@ -9,3 +9,26 @@ apt install -y libcamera-apps
 apt install -y samba samba-common-bin
 
 
+
+# Browser libraries, vendored beside the servers so pages work without internet access
+cd "$(dirname "$0")" || exit 1
+
+# OpenSeadragon for the photo viewer, served from app/static
+OSD_VERSION=4.1.1
+if ! wget -qO /tmp/openseadragon.zip https://github.com/openseadragon/openseadragon/releases/download/v$OSD_VERSION/openseadragon-bin-$OSD_VERSION.zip \
+        || ! unzip -qo /tmp/openseadragon.zip -d /tmp; then
+    echo "Could not download OpenSeadragon $OSD_VERSION; /view will not work until it is in app/static/openseadragon" >&2
+    exit 1
+fi
+rm -rf app/static/openseadragon && mkdir -p app/static
+mv /tmp/openseadragon-bin-$OSD_VERSION app/static/openseadragon
+test -f app/static/openseadragon/openseadragon.min.js || { echo "OpenSeadragon archive had no openseadragon.min.js" >&2; exit 1; }
+
+# hls.js for /live, served from static
+HLS_VERSION=1.5.15
+mkdir -p static/hls
+if ! wget -qO static/hls/hls.min.js https://cdn.jsdelivr.net/npm/hls.js@$HLS_VERSION/dist/hls.min.js; then
+    rm -f static/hls/hls.min.js
+    echo "Could not download hls.js $HLS_VERSION; /live only plays in browsers with native HLS until it is in static/hls" >&2
+    exit 1
+fi
@@ -0,0 +1,147 @@
+"""JPEG encoder backends for the video streams.
+
+Each stream gets its own encoder instance, so quality and chroma
+subsampling can differ per stream.  Encoders accept frames in the pixel
+layouts listed in their formats attribute (Picamera2 names, plus "BGR" for
+plain OpenCV arrays) without a colour conversion; anything else is
+converted to BGR by the pipeline first.  simplejpeg can encode the camera's
+YUV420 planes directly, which skips both the conversion and the encoder's
+own RGB -> YCbCr pass.
+
+Run `python benchmark.py --encoders` to compare the backends.
+"""
+import io
+import os
+
+import cv2
+import numpy as np
+
+# Memory order of each pixel layout
+BGR_ORDER = {"BGR", "RGB888", "XRGB8888"}
+RGB_ORDER = {"BGR888", "XBGR8888"}
+SUBSAMPLING = ("444", "422", "420")
+
+
+def to_rgb(array, fmt):
+    """Return an RGB-ordered, 3-channel view or copy of a BGR/RGB frame."""
+    if fmt in RGB_ORDER:
+        return array[..., :3]
+    return array[..., 2::-1]
+
+
+def yuv420_planes(array, width, height):
+    """Split a Picamera2 YUV420 buffer (rows kept at full stride) into Y, U, V."""
+    y = array[:height, :width]
+    # The U and V rows are half the stride, so view the chroma area two per row
+    chroma = array.reshape((array.shape[0] * 2, array.strides[0] // 2))
+    u = chroma[2 * height:2 * height + height // 2, :width // 2]
+    v = chroma[2 * height + height // 2:, :width // 2]
+    return y, u, v
+
+
+class JpegEncoder:
+    """Base class: encode(array, fmt, width) -> JPEG bytes."""
+
+    name = None
+    formats = frozenset()
+
+    def __init__(self, quality=95, subsampling="420", fast_dct=False):
+        if subsampling not in SUBSAMPLING:
+            raise ValueError(f"Unsupported chroma subsampling: {subsampling}")
+        self.quality = int(quality)
+        self.subsampling = subsampling
+        self.fast_dct = fast_dct
+
+    def encode(self, array, fmt="BGR", width=None):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return (f"{type(self).__name__}(quality={self.quality}, subsampling={self.subsampling!r}, "
+                f"fast_dct={self.fast_dct})")
+
+
+class OpenCVEncoder(JpegEncoder):
+    """cv2.imencode; takes BGR(X) arrays as they are.  No fast-DCT option."""
+
+    name = "opencv"
+    formats = frozenset(BGR_ORDER)
+
+    def __init__(self, quality=95, subsampling="420", fast_dct=False):
+        super().__init__(quality, subsampling, fast_dct)
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        # Sampling control needs OpenCV 4.5.5 or later
+        factor = getattr(cv2, f"IMWRITE_JPEG_SAMPLING_FACTOR_{subsampling}", None)
+        if factor is not None:
+            self.params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, factor]
+
+    def encode(self, array, fmt="BGR", width=None):
+        if fmt in RGB_ORDER:
+            array = cv2.cvtColor(array, cv2.COLOR_RGBA2BGR if array.shape[2] == 4 else cv2.COLOR_RGB2BGR)
+        success, buffer = cv2.imencode('.jpg', array, self.params)
+        if not success:
+            raise RuntimeError("Failed to encode frame.")
+        return buffer.tobytes()
+
+
+class SimpleJpegEncoder(JpegEncoder):
+    """simplejpeg (libjpeg-turbo); also encodes YUV420 planes directly."""
+
+    name = "simplejpeg"
+    formats = frozenset(BGR_ORDER | RGB_ORDER | {"YUV420"})
+    COLORSPACES = {"BGR": "BGR", "RGB888": "BGR", "XRGB8888": "BGRX", "BGR888": "RGB", "XBGR8888": "RGBX"}
+
+    def __init__(self, quality=95, subsampling="420", fast_dct=False):
+        import simplejpeg
+
+        super().__init__(quality, subsampling, fast_dct)
+        self.simplejpeg = simplejpeg
+
+    def encode(self, array, fmt="BGR", width=None):
+        if fmt == "YUV420":
+            # Subsampling is fixed at 4:2:0 by the planes themselves
+            height = array.shape[0] * 2 // 3
+            y, u, v = yuv420_planes(array, width or array.shape[1], height)
+            return self.simplejpeg.encode_jpeg_yuv_planes(y, u, v, quality=self.quality, fastdct=self.fast_dct)
+        return self.simplejpeg.encode_jpeg(np.ascontiguousarray(array), quality=self.quality,
+                                           colorspace=self.COLORSPACES[fmt],
+                                           colorsubsampling=self.subsampling, fastdct=self.fast_dct)
+
+
+class PillowEncoder(JpegEncoder):
+    """Pillow; takes RGB arrays as they are.  No fast-DCT option."""
+
+    name = "pillow"
+    formats = frozenset({"BGR888"})
+    PIL_SUBSAMPLING = {"444": 0, "422": 1, "420": 2}
+
+    def __init__(self, quality=95, subsampling="420", fast_dct=False):
+        from PIL import Image
+
+        super().__init__(quality, subsampling, fast_dct)
+        self.Image = Image
+
+    def encode(self, array, fmt="BGR", width=None):
+        image = self.Image.fromarray(np.ascontiguousarray(to_rgb(array, fmt)))
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=self.quality, subsampling=self.PIL_SUBSAMPLING[self.subsampling])
+        return output.getvalue()
+
+
+ENCODERS = {encoder.name: encoder for encoder in (OpenCVEncoder, SimpleJpegEncoder, PillowEncoder)}
+
+
+def create_encoder(name=None, **options):
+    """Create an encoder by name, defaulting to the JPEG_* environment settings.
+
+    JPEG_ENCODER picks the backend (opencv, simplejpeg or pillow);
+    JPEG_QUALITY, JPEG_SUBSAMPLING and JPEG_FAST_DCT=1 set its options.
+    """
+    name = name or os.environ.get("JPEG_ENCODER", "opencv")
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown JPEG encoder: {name}")
+    if os.environ.get("JPEG_QUALITY"):
+        options.setdefault("quality", int(os.environ["JPEG_QUALITY"]))
+    if os.environ.get("JPEG_SUBSAMPLING"):
+        options.setdefault("subsampling", os.environ["JPEG_SUBSAMPLING"])
+    options.setdefault("fast_dct", os.environ.get("JPEG_FAST_DCT") == "1")
+    return ENCODERS[name](**options)
@@ -0,0 +1,225 @@
+"""SQLite index of the captured photos.
+
+Listing /home/scanpi/photos to find the newest file, or stat()ing it on
+every photo request, gets slow once the folder holds tens of thousands of
+scans.  The catalog records each photo as it is written and answers the
+latest / by folder / by tag / by time range queries from indexes instead;
+sync() catches up with files added or removed behind its back (over Samba,
+say), stat()ing only the files of directories whose mtime has changed
+since the last sync.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from PIL import Image
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS photos (
+    path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    tags TEXT NOT NULL DEFAULT '',
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    taken REAL NOT NULL,
+    width INTEGER,
+    height INTEGER
+);
+CREATE INDEX IF NOT EXISTS photos_taken ON photos (taken);
+CREATE INDEX IF NOT EXISTS photos_folder_taken ON photos (folder, taken);
+CREATE TABLE IF NOT EXISTS photo_tags (
+    tag TEXT NOT NULL,
+    path TEXT NOT NULL REFERENCES photos (path) ON DELETE CASCADE,
+    PRIMARY KEY (tag, path)
+);
+CREATE TABLE IF NOT EXISTS folders (
+    folder TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+"""
+
+COLUMNS = "path, folder, tags, size, mtime, taken, width, height"
+EXTENSIONS = (".jpg", ".jpeg")
+
+
+def split_tags(tags):
+    """Return the distinct, lower-cased tags in a comma-separated string."""
+    return sorted({tag.strip().lower() for tag in (tags or "").split(",") if tag.strip()})
+
+
+class PhotoCatalog:
+    """Catalog of the photos under root, stored in db_path (default root/.catalog.db).
+
+    Paths are relative to root, with / separators; folder is the directory
+    part ("" for root itself).  One connection is shared by the writer
+    threads, the sync thread and the event loop, guarded by a lock; every
+    query is a single indexed lookup, so holding it is brief.
+    """
+
+    def __init__(self, root, db_path=None):
+        self.root = os.path.abspath(root)
+        self.db_path = db_path or os.path.join(self.root, ".catalog.db")
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._db.executescript(SCHEMA)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def relative(self, path):
+        """Return path relative to the root, with / separators."""
+        return os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, "/")
+
+    def record(self, path, tags=None, taken=None, width=None, height=None, size=None, mtime=None):
+        """Add or update the photo at path (absolute, or relative to the root)."""
+        absolute = path if os.path.isabs(path) else os.path.join(self.root, path)
+        if size is None or mtime is None:
+            st = os.stat(absolute)
+            size, mtime = st.st_size, st.st_mtime
+        relative = self.relative(absolute)
+        tag_list = split_tags(tags)
+        row = (relative, os.path.dirname(relative), ",".join(tag_list), size, mtime, taken or mtime, width, height)
+        with self._lock, self._db:
+            self._db.execute(f"INSERT OR REPLACE INTO photos ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row)
+            self._db.execute("DELETE FROM photo_tags WHERE path = ?", (relative,))
+            self._db.executemany("INSERT INTO photo_tags (tag, path) VALUES (?, ?)",
+                                 [(tag, relative) for tag in tag_list])
+
+    def remove(self, path):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM photos WHERE path = ?", (self.relative(path) if os.path.isabs(path) else path,))
+
+    def _query(self, where="", params=(), limit=100, offset=0, join=""):
+        sql = (f"SELECT {', '.join('photos.' + c for c in COLUMNS.split(', '))} FROM photos {join} {where} "
+               "ORDER BY taken DESC LIMIT ? OFFSET ?")
+        with self._lock:
+            return [dict(row) for row in self._db.execute(sql, (*params, limit, offset))]
+
+    def get(self, path):
+        """Return the entry for a relative path, or None if it is not catalogued."""
+        with self._lock:
+            row = self._db.execute(f"SELECT {COLUMNS} FROM photos WHERE path = ?", (path,)).fetchone()
+        return dict(row) if row else None
+
+    def latest(self, folder=None):
+        """Return the most recently taken photo (in folder, if given), or None."""
+        rows = self.by_folder(folder, limit=1) if folder is not None else self._query(limit=1)
+        return rows[0] if rows else None
+
+    def by_folder(self, folder, limit=100, offset=0):
+        return self.find(folder=folder, limit=limit, offset=offset)
+
+    def by_tag(self, tag, limit=100, offset=0):
+        return self.find(tag=tag, limit=limit, offset=offset)
+
+    def between(self, start=None, end=None, limit=100, offset=0):
+        """Photos taken in [start, end), as Unix timestamps; either bound may be None."""
+        return self.find(start=start, end=end, limit=limit, offset=offset)
+
+    def find(self, folder=None, tag=None, start=None, end=None, limit=100, offset=0):
+        """Photos matching every filter given: folder, tag and a [start, end) range of Unix times."""
+        clauses, params, join = [], [], ""
+        if folder is not None:
+            clauses.append("photos.folder = ?")
+            params.append(folder.strip("/"))
+        if tag is not None:
+            clauses.append("photo_tags.tag = ?")
+            params.append(tag.strip().lower())
+            join = "JOIN photo_tags ON photo_tags.path = photos.path"
+        if start is not None:
+            clauses.append("photos.taken >= ?")
+            params.append(start)
+        if end is not None:
+            clauses.append("photos.taken < ?")
+            params.append(end)
+        where = "WHERE " + " AND ".join(clauses) if clauses else ""
+        return self._query(where, params, limit, offset, join)
+
+    def count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM photos").fetchone()[0]
+
+    def _read_photo(self, absolute):
+        """Return (width, height, tags) from a JPEG's header and EXIF, reading no pixel data."""
+        try:
+            with Image.open(absolute) as image:
+                description = image.getexif().get(0x010E)  # ImageDescription
+                return image.width, image.height, description if isinstance(description, str) else None
+        except (OSError, SyntaxError) as e:
+            logging.warning(f"Cannot read {absolute}: {e}")
+            return None, None, None
+
+    def sync(self):
+        """Bring the catalog in line with the files under the root; returns (added, removed)."""
+        start = time.perf_counter()
+        with self._lock:
+            folder_mtimes = dict(self._db.execute("SELECT folder, mtime FROM folders"))
+            known_folders = {row[0] for row in self._db.execute("SELECT DISTINCT folder FROM photos")}
+        added = removed = 0
+        seen_folders = set()
+        pending = [""]
+        while pending:
+            folder = pending.pop()
+            seen_folders.add(folder)
+            directory = os.path.join(self.root, folder)
+            try:
+                mtime = os.stat(directory).st_mtime
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                continue
+            pending += [f"{folder}/{e.name}".lstrip("/") for e in entries
+                        if e.is_dir(follow_symlinks=False) and not e.name.startswith(".")]
+            if folder_mtimes.get(folder) == mtime:
+                continue  # No file added, removed or renamed here since the last sync
+            files = {f"{folder}/{e.name}".lstrip("/"): e for e in entries
+                     if e.is_file() and not e.name.startswith(".") and e.name.lower().endswith(EXTENSIONS)}
+            with self._lock:
+                known = {row[0]: (row[1], row[2]) for row in self._db.execute(
+                    "SELECT path, size, mtime FROM photos WHERE folder = ?", (folder,))}
+            for path, entry in files.items():
+                st = entry.stat()
+                if known.get(path) == (st.st_size, st.st_mtime):
+                    continue
+                width, height, tags = self._read_photo(entry.path)
+                self.record(entry.path, tags, width=width, height=height, size=st.st_size, mtime=st.st_mtime)
+                added += 1
+            gone = [path for path in known if path not in files]
+            with self._lock, self._db:
+                self._db.executemany("DELETE FROM photos WHERE path = ?", [(path,) for path in gone])
+                self._db.execute("INSERT OR REPLACE INTO folders (folder, mtime) VALUES (?, ?)", (folder, mtime))
+            removed += len(gone)
+        # Folders deleted since the last sync take their photos with them
+        with self._lock, self._db:
+            for folder in (known_folders | set(folder_mtimes)) - seen_folders:
+                removed += self._db.execute("DELETE FROM photos WHERE folder = ?", (folder,)).rowcount
+                self._db.execute("DELETE FROM folders WHERE folder = ?", (folder,))
+        if added or removed:
+            logging.info(f"Photo catalog synced: {added} added, {removed} removed "
+                         f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+        return added, removed
+
+    def run(self, interval=60.0):
+        """Sync every interval seconds until stop() is called."""
+        while not self._stop.is_set():
+            try:
+                self.sync()
+            except Exception as e:
+                logging.error(f"Photo catalog sync failed: {e}")
+            self._stop.wait(interval)
+
+    def start(self, interval=60.0):
+        """Sync now and then every interval seconds on a daemon thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            self._thread = None
@@ -0,0 +1,124 @@
+"""HTTP delivery of photo files: validators, byte ranges and server offload.
+
+Photos are written once under a unique name and never modified, so their
+size and mtime make a strong ETag.  A browser revalidating a gallery gets
+304 Not Modified instead of the file again, an interrupted download of a
+large still or recording resumes with a Range request, and the body is
+streamed in large chunks, each read on a worker thread so a slow SD card
+never stalls the event loop.  Every byte is still copied through Python.
+
+Hypercorn has no sendfile() path, so to have the kernel send files put
+nginx (or Apache/lighttpd) in front and set PHOTO_SENDFILE to
+X-Accel-Redirect (or X-Sendfile): the app then only answers with headers
+and the proxy sends the file itself, ranges included.  PHOTO_SENDFILE_PREFIX is the internal nginx
+location that maps onto the photo directory.
+"""
+import asyncio
+import os
+from datetime import datetime, timezone
+
+from quart import Response, request
+
+CHUNK_SIZE = 256 * 1024
+# Photos never change once written; browsers must still revalidate in case one was deleted
+CACHE_CONTROL = "no-cache"
+
+
+def file_validators(path):
+    """Return (etag, last_modified, size) for the file at path."""
+    st = os.stat(path)
+    etag = f"{st.st_size:x}-{st.st_mtime_ns:x}"
+    return etag, datetime.fromtimestamp(int(st.st_mtime), timezone.utc), st.st_size
+
+
+def _with_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    return response
+
+
+def not_modified(etag, last_modified):
+    """Return a 304 response if the request's validators still match, else None."""
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since is not None:
+        fresh = last_modified <= request.if_modified_since
+    else:
+        fresh = False
+    return _with_validators(Response(b"", status=304), etag, last_modified) if fresh else None
+
+
+def _requested_range(etag, last_modified, size):
+    """Return (start, stop) for a satisfiable single range, None for the whole file, or False if unsatisfiable."""
+    ranges = request.range
+    if ranges is None or ranges.units != "bytes" or len(ranges.ranges) != 1:
+        return None  # No range, or several: send the whole file
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and if_range.date != last_modified:
+        return None
+    return ranges.range_for_length(size) or False
+
+
+def _read_chunk(f, offset, length):
+    f.seek(offset)
+    return f.read(length)
+
+
+async def _file_chunks(path, start, stop):
+    """Yield bytes start..stop of the file, reading off the event loop."""
+    if stop == start:
+        return
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        for offset in range(start, stop, CHUNK_SIZE):
+            chunk = await asyncio.to_thread(_read_chunk, f, offset, min(CHUNK_SIZE, stop - offset))
+            if not chunk:
+                break  # Truncated since it was stat'ed
+            yield chunk
+    finally:
+        f.close()
+
+
+async def send_photo(path, mimetype="image/jpeg", root=None):
+    """Serve the file at path with ETag/Last-Modified, 304s and single byte ranges.
+
+    root is the directory PHOTO_SENDFILE_PREFIX maps to; with PHOTO_SENDFILE
+    set the file itself is left to the proxy.  Raises FileNotFoundError if
+    path does not exist.
+    """
+    etag, last_modified, size = file_validators(path)
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
+
+    offload = os.environ.get("PHOTO_SENDFILE")
+    if offload:
+        response = Response(b"", content_type=mimetype)
+        if offload.lower() == "x-accel-redirect":
+            relative = os.path.relpath(path, root or os.path.dirname(path)).replace(os.sep, "/")
+            response.headers["X-Accel-Redirect"] = os.environ.get("PHOTO_SENDFILE_PREFIX", "/photos/") + relative
+        else:
+            response.headers[offload] = os.path.abspath(path)
+        return _with_validators(response, etag, last_modified)
+
+    byte_range = _requested_range(etag, last_modified, size)
+    if byte_range is False:
+        response = Response(b"", status=416)
+        response.headers["Content-Range"] = f"bytes */{size}"
+        return response
+    start, stop = byte_range or (0, size)
+    response = Response(_file_chunks(path, start, stop), status=206 if byte_range else 200, content_type=mimetype)
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers["Content-Length"] = str(stop - start)
+    if byte_range:
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    return _with_validators(response, etag, last_modified)
+
+
+def send_data(data, etag, last_modified, mimetype="image/jpeg"):
+    """Serve in-memory bytes (a thumbnail, say) under the given validators."""
+    response = Response(data, content_type=mimetype)
+    return _with_validators(response, etag, last_modified)
@@ -0,0 +1,188 @@
+"""Encode and save captured stills off the capture path."""
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from frame_stats import StageStats
+from jpeg_encoders import create_encoder
+from photo_exif import insert_exif
+
+FSYNC_POLICIES = ("none", "file", "full")
+
+
+class PhotoWriter:
+    """Write-behind store for captured stills.
+
+    submit() returns as soon as a still is queued; a pool of worker threads
+    encodes and writes it.  At most max_pending stills wait at once, so when
+    the card falls behind a capture blocks rather than filling the Pi's
+    memory with 12MP frames.
+
+    Each file is written under a hidden temporary name and only then linked
+    into place, so Samba readers never see a partial JPEG.  fsync sets how
+    hard the data is pushed to the card first: "none", "file" (the JPEG
+    before it is renamed) or "full" (the directory entry too); the
+    PHOTO_FSYNC environment variable gives the default.
+
+    next_path() hands out names with millisecond timestamps and a
+    per-process sequence number, and a photo is never renamed over an
+    existing file, so two shots in the same second (or a burst) can never
+    overwrite each other.
+
+    catalog, a photo_catalog.PhotoCatalog, gets a record of every photo as
+    soon as it is in place.  derivatives are warmed from the still's pixels
+    while they are still in memory: anything with a warm(path, array)
+    method, such as photo_thumbs.ThumbnailCache.
+    """
+
+    def __init__(self, directory, workers=2, quality=95, prefix="photo", encoder=None, max_pending=8,
+                 fsync=None, catalog=None, derivatives=()):
+        fsync = fsync or os.environ.get("PHOTO_FSYNC", "file")
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.directory = directory
+        self.prefix = prefix
+        self.encoder = encoder or create_encoder(quality=quality)
+        self.fsync = fsync
+        self.catalog = catalog
+        self.derivatives = tuple(derivatives)
+        self.max_pending = max_pending
+        self.written = 0
+        self.failed = 0
+        self.bytes_written = 0
+        self.last_error = None
+        self.write_stats = StageStats()
+        self._pending = {}
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._sequence = itertools.count(1)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="photo-writer")
+        os.makedirs(directory, exist_ok=True)
+
+    def next_path(self, prefix=None, folder=None, extension=".jpg"):
+        """Return a new, collision-free photo (or clip) path, in a subfolder if given.
+
+        Raises ValueError for a folder that would lead outside the directory.
+        """
+        directory = self.directory
+        if folder:
+            folder = os.path.normpath(folder.strip("/"))
+            if folder.startswith("..") or os.path.isabs(folder):
+                raise ValueError(f"Invalid folder: {folder}")
+            directory = os.path.join(self.directory, folder)
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            sequence = next(self._sequence)
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
+        return os.path.join(directory, f"{prefix or self.prefix}_{stamp}_{sequence:04d}{extension}")
+
+    def write(self, array, path, exif=None, tags=None, taken=None):
+        """Encode array and write it to path on the calling thread; returns seconds taken.
+
+        exif, from photo_exif.build_exif(), is spliced into the encoded bytes;
+        tags and taken (a Unix time) go into the catalog entry.
+        """
+        taken = taken or time.time()
+        start = time.perf_counter()
+        data = self.encoder.encode(array, "BGR")
+        if exif:
+            data = insert_exif(data, exif)
+        mtime = self._persist(data, path)
+        if self.catalog is not None:
+            self.catalog.record(path, tags, taken, width=array.shape[1], height=array.shape[0], size=len(data),
+                                mtime=mtime)
+        for derivative in self.derivatives:
+            derivative.warm(path, array)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.written += 1
+            self.bytes_written += len(data)
+            self.write_stats.record(elapsed)
+        logging.info(f"Photo saved: {path} ({len(data) // 1024} KB in {elapsed * 1000:.0f} ms)")
+        return elapsed
+
+    def _persist(self, data, path):
+        """Write data to a temporary file beside path, then move it into place atomically; returns its mtime."""
+        directory, name = os.path.split(path)
+        temp = os.path.join(directory, f".{name}.tmp")
+        try:
+            with open(temp, "xb") as f:
+                f.write(data)
+                f.flush()
+                if self.fsync != "none":
+                    os.fsync(f.fileno())
+                # Kept through the link or rename below, so the catalog needs no stat of its own
+                mtime = os.fstat(f.fileno()).st_mtime
+            try:
+                # A hard link fails rather than replace an existing photo
+                os.link(temp, path)
+            except FileExistsError:
+                raise
+            except OSError:
+                # Cards formatted FAT/exFAT have no hard links; a rename is still atomic
+                os.replace(temp, path)
+            else:
+                os.unlink(temp)
+        except BaseException:
+            if os.path.exists(temp):
+                os.unlink(temp)
+            raise
+        if self.fsync == "full":
+            fd = os.open(directory or ".", os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return mtime
+
+    def _write_pending(self, array, path, exif, tags, taken):
+        try:
+            return self.write(array, path, exif, tags, taken)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+                self.last_error = f"{os.path.basename(path)}: {e}"
+            logging.error(f"Failed to save photo {path}: {e}")
+            raise
+        finally:
+            with self._lock:
+                del self._pending[path]
+            self._slots.release()
+
+    def submit(self, array, path=None, timeout=30.0, exif=None, tags=None):
+        """Queue array for a worker; returns (path, future of the write's seconds).
+
+        Blocks while max_pending stills are already waiting and raises
+        RuntimeError if no slot frees up within timeout seconds.
+        """
+        if not self._slots.acquire(timeout=timeout):
+            raise RuntimeError("Photo write queue is full.")
+        path = path or self.next_path()
+        with self._lock:
+            self._pending[path] = time.monotonic()
+        return path, self._executor.submit(self._write_pending, array, path, exif, tags, time.time())
+
+    def status(self):
+        """Return queue depth, the paths still being written and write totals."""
+        now = time.monotonic()
+        with self._lock:
+            pending = sorted(self._pending.items(), key=lambda item: item[1])
+            return {
+                "pending": len(pending),
+                "max_pending": self.max_pending,
+                "pending_photos": [{"photo": path, "waiting_s": round(now - since, 3)} for path, since in pending],
+                "written": self.written,
+                "failed": self.failed,
+                "bytes_written": self.bytes_written,
+                "last_error": self.last_error,
+                "fsync": self.fsync,
+                "write": self.write_stats.as_dict(),
+            }
+
+    def shutdown(self, wait=True):
+        """Stop accepting stills; with wait, return once every pending one is on disk."""
+        self._executor.shutdown(wait=wait)
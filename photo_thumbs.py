@@ -0,0 +1,187 @@
+"""Resized renditions of captured photos for previews and gallery pages.
+
+Thumbnails are decoded with Pillow's JPEG draft mode, which has libjpeg
+scale the DCT by 1/2, 1/4 or 1/8 while decoding, so a 320-wide preview of a
+12MP still never decodes the full image.  Rendered thumbnails are kept in
+an in-memory LRU and in a hidden .thumbs folder, keyed by path, mtime,
+size and width, so a photo is only ever resized once per width; the folder
+is held to max_disk_bytes by deleting the least recently used files.
+"""
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+from frame_stats import StageStats
+
+# Requested widths are rounded up to one of these, so the cache holds a few renditions per photo
+WIDTHS = (160, 320, 640, 1280, 2048)
+
+# Cached in place of a rendition when the photo is no wider than it, so the check is not repeated
+NO_RENDITION = b""
+
+
+class ThumbnailCache:
+    """Thumbnails of the photos under root, cached in memory and in cache_dir.
+
+    warm() renders the warm_widths of a photo that was just written, from
+    the array still in memory when one is given, so the first gallery view
+    of a new capture is already cached.  Both paths resize with Pillow's
+    LANCZOS filter, so a warmed thumbnail matches one rendered on a miss.
+    """
+
+    def __init__(self, root, cache_dir=None, max_items=256, quality=80, warm_widths=(320,),
+                 max_disk_bytes=64 * 1024 * 1024):
+        self.root = os.path.abspath(root)
+        self.cache_dir = cache_dir or os.path.join(self.root, ".thumbs")
+        self.max_items = max_items
+        self.quality = quality
+        self.warm_widths = warm_widths
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.evicted = 0
+        self.render_stats = StageStats()
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.cache_dir)
+                               if entry.is_file() and entry.name.endswith(".jpg"))
+
+    @staticmethod
+    def snap(width):
+        """Round a requested width up to the nearest cached width."""
+        return next((w for w in WIDTHS if w >= width), WIDTHS[-1])
+
+    def _key(self, absolute, width):
+        st = os.stat(absolute)
+        key = f"{os.path.relpath(absolute, self.root)}|{st.st_mtime_ns}|{st.st_size}|{width}"
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _remember(self, key, data):
+        with self._lock:
+            self._memory[key] = data
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    def _store(self, key, data):
+        """Keep data in memory and on disk; the disk copy is renamed into place whole."""
+        self._remember(key, data)
+        path = os.path.join(self.cache_dir, f"{key}.jpg")
+        temp = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp, "wb") as f:
+            f.write(data)
+        os.replace(temp, path)
+        with self._lock:
+            self._disk_bytes += len(data)
+            over = self._disk_bytes > self.max_disk_bytes
+        if over:
+            self._evict()
+
+    def _evict(self):
+        """Delete the least recently used files until the folder is back under three quarters of its budget."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(".jpg"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_disk_bytes * 3 // 4:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evicted += 1
+        with self._lock:
+            self._disk_bytes = total
+
+    def get(self, path, width):
+        """Return JPEG bytes of the photo at path (relative to root) scaled to width.
+
+        Returns None when the photo is no wider than the rendition, or the
+        width is beyond the largest cached one, in which case the original
+        should be sent.  Raises FileNotFoundError for a missing photo.
+        """
+        if width > WIDTHS[-1]:
+            return None
+        absolute = os.path.join(self.root, path)
+        width = self.snap(width)
+        key = self._key(absolute, width)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return data or None
+        path = os.path.join(self.cache_dir, f"{key}.jpg")
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Marks the file recently used for _evict()
+            os.utime(path)
+            self.disk_hits += 1
+            self._remember(key, data)
+            return data or None
+        except FileNotFoundError:
+            pass
+        data = self._render(absolute, width)
+        self._store(key, data)
+        return data or None
+
+    def _render(self, absolute, width):
+        """Return JPEG bytes of the photo file scaled to width, or NO_RENDITION if it is no wider."""
+        start = time.perf_counter()
+        with Image.open(absolute) as image:
+            if image.width <= width:
+                return NO_RENDITION
+            # Let libjpeg decode at the smallest 1/2^n scale that is still at least this big
+            image.draft("RGB", (width, round(image.height * width / image.width)))
+            data = self._resize(image.convert("RGB"), width)
+        self.render_stats.record(time.perf_counter() - start)
+        return data
+
+    def _resize(self, image, width):
+        """Scale an RGB image to width and encode it; the one resize path for misses and warm()."""
+        height = round(image.height * width / image.width)
+        image = image.resize((width, height), Image.LANCZOS, reducing_gap=2.0)
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=self.quality)
+        return output.getvalue()
+
+    def warm(self, path, array=None):
+        """Render the warm_widths of a freshly written photo (absolute path).
+
+        With array, the BGR pixels that were just encoded, thumbnails are
+        resized from memory and the photo is not decoded at all.
+        """
+        for width in self.warm_widths:
+            width = self.snap(width)
+            try:
+                key = self._key(path, width)
+                if array is None:
+                    data = self._render(path, width)
+                elif array.shape[1] > width:
+                    # BGR to RGB as a reversed view; Pillow copies it out
+                    data = self._resize(Image.fromarray(array[:, :, 2::-1]), width)
+                else:
+                    data = NO_RENDITION
+                self._store(key, data)
+            except Exception as e:
+                logging.warning(f"Cannot warm thumbnail of {path}: {e}")
+
+    def stats(self):
+        with self._lock:
+            cached = len(self._memory)
+            disk_bytes = self._disk_bytes
+        return {"memory_items": cached, "memory_hits": self.hits, "disk_hits": self.disk_hits,
+                "disk_bytes": disk_bytes, "evicted": self.evicted, "render": self.render_stats.as_dict()}
@@ -0,0 +1,208 @@
+"""Deep Zoom (DZI) tile pyramids for full-resolution stills.
+
+A viewer such as OpenSeadragon then fetches only the 256-pixel tiles in
+view at the current zoom, instead of downloading and decoding a whole 12MP
+JPEG on a tablet.  Level n of the pyramid is the image scaled by
+1/2^(max_level - n), down to a single pixel, cut into tile_size tiles that
+overlap their neighbours by overlap pixels.
+
+Pyramids live in a hidden .tiles folder, one directory per photo keyed by
+path, mtime and size, and are built only when a photo is first viewed:
+prefetch() queues the build on a single low-priority worker when the viewer
+page is served, and dzi() or tile() build a pyramid that is still missing.
+The folder is held to max_disk_bytes by deleting the least recently viewed
+pyramids.
+"""
+import hashlib
+import logging
+import math
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import cv2
+
+from frame_stats import StageStats
+
+DZI_TEMPLATE = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile_size}" '
+                'Overlap="{overlap}" Format="jpg"><Size Width="{width}" Height="{height}"/></Image>\n')
+
+
+class TilePyramid:
+    """DZI pyramids of the photos under root, stored in cache_dir."""
+
+    def __init__(self, root, cache_dir=None, tile_size=254, overlap=1, quality=85,
+                 max_disk_bytes=1024 * 1024 * 1024):
+        self.root = os.path.abspath(root)
+        self.cache_dir = cache_dir or os.path.join(self.root, ".tiles")
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.quality = quality
+        self.max_disk_bytes = max_disk_bytes
+        self.evicted = 0
+        self.generate_stats = StageStats()
+        # directory -> [lock, users]; an entry lives only while a build of that pyramid is wanted
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tile-pyramid")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._disk_bytes = sum(size for _, size, _ in self._pyramids())
+
+    def _key(self, absolute):
+        st = os.stat(absolute)
+        key = f"{os.path.relpath(absolute, self.root)}|{st.st_mtime_ns}|{st.st_size}"
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _directory(self, absolute):
+        return os.path.join(self.cache_dir, self._key(absolute))
+
+    @contextmanager
+    def _photo_lock(self, directory):
+        """Hold the build lock of one pyramid, dropping it once nobody else is waiting for it."""
+        with self._lock:
+            entry = self._locks.setdefault(directory, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[directory]
+
+    def _pyramids(self):
+        """Return (mtime, bytes, directory) of every finished pyramid."""
+        pyramids = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir() and not entry.name.endswith(".tmp"):
+                try:
+                    with open(os.path.join(entry.path, "bytes")) as f:
+                        size = int(f.read())
+                    pyramids.append((entry.stat().st_mtime, size, entry.path))
+                except (OSError, ValueError):
+                    continue  # Incomplete; rebuilt when next viewed
+        return pyramids
+
+    def _evict(self, keep):
+        """Delete the least recently viewed pyramids, except keep, until under three quarters of the budget."""
+        pyramids = sorted(self._pyramids())
+        total = sum(size for _, size, _ in pyramids)
+        for _, size, directory in pyramids:
+            if total <= self.max_disk_bytes * 3 // 4:
+                break
+            if directory == keep:
+                continue
+            shutil.rmtree(directory, ignore_errors=True)
+            total -= size
+            self.evicted += 1
+        with self._lock:
+            self._disk_bytes = total
+
+    def prefetch(self, path):
+        """Queue the pyramid of the photo at path (relative to root) to be built in the background."""
+        self._executor.submit(self._prefetch, os.path.join(self.root, path))
+
+    def _prefetch(self, absolute):
+        try:
+            self.ensure(absolute)
+        except Exception as e:
+            logging.warning(f"Cannot build tile pyramid of {absolute}: {e}")
+
+    def dzi(self, path):
+        """Return the DZI descriptor of the photo at path (relative to root), building its pyramid if needed."""
+        directory = self.ensure(os.path.join(self.root, path))
+        # Marks the pyramid recently viewed for _evict()
+        os.utime(directory)
+        with open(os.path.join(directory, "image.dzi")) as f:
+            return f.read()
+
+    def tile(self, path, level, col, row):
+        """Return the file path of one tile; FileNotFoundError if the photo or tile does not exist."""
+        directory = self.ensure(os.path.join(self.root, path))
+        tile_path = os.path.join(directory, str(level), f"{col}_{row}.jpg")
+        if not os.path.exists(tile_path):
+            raise FileNotFoundError(tile_path)
+        return tile_path
+
+    def ensure(self, absolute):
+        """Return the pyramid directory of a photo, decoding and tiling it first if it has none."""
+        directory = self._directory(absolute)
+        if os.path.exists(os.path.join(directory, "image.dzi")):
+            return directory
+        image = cv2.imread(absolute, cv2.IMREAD_COLOR)
+        if image is None:
+            raise FileNotFoundError(absolute)
+        return self.generate(absolute, image)
+
+    def generate(self, absolute, image):
+        """Build the pyramid of the photo at absolute from its BGR pixels; returns its directory.
+
+        The descriptor and byte count are written last, so a pyramid without
+        them is incomplete and is rebuilt.
+        """
+        directory = self._directory(absolute)
+        with self._photo_lock(directory):
+            if os.path.exists(os.path.join(directory, "image.dzi")):
+                return directory
+            start = time.perf_counter()
+            temp = f"{directory}.{threading.get_ident()}.tmp"
+            shutil.rmtree(temp, ignore_errors=True)
+            height, width = image.shape[:2]
+            max_level = math.ceil(math.log2(max(width, height)))
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+            written = 0
+            for level in range(max_level, -1, -1):
+                if level < max_level:
+                    # Each level halves the one above, which is far cheaper than rescaling the original
+                    size = (max(math.ceil(image.shape[1] / 2), 1), max(math.ceil(image.shape[0] / 2), 1))
+                    image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+                written += self._write_level(image, os.path.join(temp, str(level)), params)
+            with open(os.path.join(temp, "image.dzi"), "w") as f:
+                f.write(DZI_TEMPLATE.format(tile_size=self.tile_size, overlap=self.overlap,
+                                            width=width, height=height))
+            with open(os.path.join(temp, "bytes"), "w") as f:
+                f.write(str(written))
+            try:
+                os.replace(temp, directory)
+            except OSError:
+                # Another process finished the same pyramid first
+                shutil.rmtree(temp, ignore_errors=True)
+                written = 0
+            self.generate_stats.record(time.perf_counter() - start)
+        logging.info(f"Tile pyramid built for {absolute} in {(time.perf_counter() - start) * 1000:.0f} ms")
+        with self._lock:
+            self._disk_bytes += written
+            over = self._disk_bytes > self.max_disk_bytes
+        if over:
+            self._evict(keep=directory)
+        return directory
+
+    def _write_level(self, image, directory, params):
+        """Write one level's tiles; returns the bytes written."""
+        os.makedirs(directory)
+        written = 0
+        height, width = image.shape[:2]
+        size, overlap = self.tile_size, self.overlap
+        for row in range(math.ceil(height / size)):
+            top = max(row * size - overlap, 0)
+            bottom = min((row + 1) * size + overlap, height)
+            for col in range(math.ceil(width / size)):
+                left = max(col * size - overlap, 0)
+                right = min((col + 1) * size + overlap, width)
+                success, buffer = cv2.imencode(".jpg", image[top:bottom, left:right], params)
+                if not success:
+                    raise RuntimeError("Failed to encode tile.")
+                with open(os.path.join(directory, f"{col}_{row}.jpg"), "wb") as f:
+                    f.write(buffer)
+                written += len(buffer)
+        return written
+
+    def stats(self):
+        with self._lock:
+            disk_bytes = self._disk_bytes
+        return {"generate": self.generate_stats.as_dict(), "disk_bytes": disk_bytes, "evicted": self.evicted}
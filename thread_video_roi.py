@@ -1,86 +1,148 @@
-from quart import Quart, websocket, render_template
+from quart import Quart, websocket, render_template, request
 import threading
-import time
-from picamera2 import Picamera2, Preview
-import cv2
 import asyncio
-from datetime import datetime
-import os
 import logging
 
+from frame_broadcast import BroadcasterClosed, FrameBroadcaster
+from frame_pipeline import FramePipeline
+from frame_protocol import JPEG, MessageCache
+from frame_roi import RoiSet
+from frame_source import open_source
+from photo_catalog import PhotoCatalog
+from photo_exif import build_exif
+from photo_store import PhotoWriter
+
 # Create a Quart app instance
 app = Quart(__name__)
 
 # Global variables
-video_frame = None
-use_roi = False  # Switch for ROI or full frame
+broadcaster = FrameBroadcaster()
+source = None
+pipeline = None
+rois = None  # Named regions, each streamed on /ws/roi/<name>
+messages = MessageCache()  # Each frame is packed once for all clients of its channel
+CENTRE_ROI = (0.25, 0.25, 0.5, 0.5)  # The centre 640x480 of a 1280x960 frame, for /toggle_roi
 lock = threading.Lock()
 photo_dir = "/home/scanpi/photos"
-os.makedirs(photo_dir, exist_ok=True)
+catalog = PhotoCatalog(photo_dir)  # Indexes every photo as it is written
+writer = PhotoWriter(photo_dir, catalog=catalog)  # Write-behind: stills are encoded and written in the background
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 
-# Initialize Picamera2
-picam2 = Picamera2()
-picam2.configure(picam2.create_video_configuration(main={"size": (1280, 960)}))  # Doubled resolution
-picam2.start()
-
-# Function to crop a region of interest (ROI)
-def crop_roi(frame, x, y, width, height):
-    return frame[y:y+height, x:x+width]
-
 # Function to capture video frames
 def video_stream():
-    global video_frame, use_roi
-    while True:
-        frame = picam2.capture_array()
-        if use_roi:
-            # Define ROI (e.g., center 640x480 region)
-            center_x, center_y = frame.shape[1] // 2, frame.shape[0] // 2
-            roi_width, roi_height = 640, 480
-            x_start = center_x - roi_width // 2
-            y_start = center_y - roi_height // 2
-            frame = crop_roi(frame, x_start, y_start, roi_width, roi_height)
-        _, buffer = cv2.imencode('.jpg', frame)
-        video_frame = buffer.tobytes()
-        time.sleep(0.03)  # Approx. 30 FPS
+    pipeline.run()
+
+async def send_frames(channel, full_view=False):
+    # Wake once per new frame; a slow client skips to the newest one
+    # Binary frame_protocol messages, like app_thread_video_working.py's /ws
+    rendition = pipeline.rendition_width(channel)
+    try:
+        with channel.client() as client:
+            if full_view:
+                # The sensor crop would turn this view into the ROI, so it goes back to software crops
+                rois.refresh()
+            while True:
+                sequence, frame = await client.get()
+                await websocket.send(messages.message(JPEG, channel, sequence, frame, rendition))
+                client.sent += 1
+    except BroadcasterClosed:
+        pass  # The ROI was deleted; returning closes the socket
+    finally:
+        if full_view:
+            rois.refresh()
 
 @app.websocket("/ws")
 async def ws():
-    global video_frame
-    while True:
-        if video_frame:
-            await websocket.send(video_frame)
-        await asyncio.sleep(0.03)
+    await send_frames(broadcaster, full_view=True)
+
+@app.websocket("/ws/roi/<name>")
+async def ws_roi(name):
+    try:
+        channel = pipeline.channel(name)
+    except KeyError:
+        return "Unknown ROI", 404
+    await send_frames(channel)
+
+@app.route("/roi", methods=["GET"])
+async def list_rois():
+    return rois.as_dict()
+
+@app.route("/roi/<name>", methods=["PUT", "POST"])
+async def set_roi(name):
+    # Body: {"x", "y", "w", "h"} normalised to the full frame, plus optional "sensor": true
+    data = await request.get_json(force=True, silent=True) or {}
+    if not isinstance(data, dict):
+        return {"error": "The body must be a JSON object"}, 400
+    try:
+        rois.set(name, data, sensor=data.get("sensor", False))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    logging.info(f"ROI {name} set to {data}")
+    return rois.as_dict()
+
+@app.route("/roi/<name>", methods=["DELETE"])
+async def delete_roi(name):
+    try:
+        rois.remove(name)
+    except KeyError:
+        return {"error": f"Unknown ROI: {name}"}, 404
+    return rois.as_dict()
 
 @app.route("/toggle_roi", methods=["POST"])
 async def toggle_roi():
-    global use_roi
-    use_roi = not use_roi
-    logging.info(f"ROI mode set to: {use_roi}")
-    return "", 204
+    # Shortcut for a sensor-cropped centre ROI, streamed on /ws/roi/centre
+    if "centre" in rois.regions:
+        rois.remove("centre")
+    else:
+        rois.set("centre", CENTRE_ROI, sensor=True)
+    enabled = "centre" in rois.regions
+    logging.info(f"ROI mode set to: {enabled}")
+    return {"enabled": enabled, "sensor_crop": rois.sensor_crop == "centre"}
 
 @app.route("/capture", methods=["POST"])
 async def capture():
     # Use a thread-safe mechanism to avoid locking issues
     def safe_capture():
         with lock:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            photo_path = os.path.join(photo_dir, f"photo_{timestamp}.jpg")
-            capture_config = picam2.create_still_configuration(main={"size": (4056, 3040)})  # Full 12MP resolution
-            array = picam2.switch_mode_and_capture_array(capture_config, "main")
-            cv2.imwrite(photo_path, array)
-            logging.info(f"Photo saved: {photo_path}")
+            array = source.capture_still()
+            latency = source.still_latency
+            exif = build_exif(metadata=source.still_metadata, model=source.model)
+        # Returns once the still is queued; /photos/status shows when it is on disk
+        photo_path, _ = writer.submit(array, exif=exif)
+        return photo_path, latency
+
+    photo_path, latency = await asyncio.to_thread(safe_capture)
+    # A region that gave up the sensor crop during the still mode switch takes it back
+    rois.refresh()
+    return {"photo": photo_path, "capture_ms": round(latency * 1000, 1)}
 
-    await asyncio.to_thread(safe_capture)
-    return "", 204
+@app.route("/photos/status")
+async def photos_status():
+    # Stills still waiting to be written, and write totals
+    return writer.status()
+
+@app.route("/stats")
+async def stats():
+    # Producer throughput, per-stage latency and CPU per frame
+    return {"clients": broadcaster.client_stats(), "pipeline": pipeline.report(), "rois": rois.as_dict(),
+            "dual_stream": source.dual_stream, "still_capture_ms": source.still_latency and source.still_latency * 1000}
 
 @app.route("/")
 async def index():
     return await render_template("index_roi.html")
 
 if __name__ == "__main__":
+    # Open the camera backend selected by CAMERA_SOURCE (picamera2, opencv or synthetic)
+    source = open_source(size=(1280, 960), fps=30, still_size=(4056, 3040))  # Doubled resolution, full 12MP stills
+    source.start()
+    pipeline = FramePipeline(source, broadcaster)  # Runs at the sensor frame rate
+    rois = RoiSet(pipeline, source)
+
+    # Keep the photo catalog in step with files added or deleted over Samba
+    catalog.start(interval=60)
+
     # Start the video stream thread
     video_thread = threading.Thread(target=video_stream, daemon=True)
     video_thread.start()